@@ -327,8 +327,26 @@ ENABLE_FTS = False
 # Bridged configuration
 BRIDGED_JUDGE_HOST = 'localhost'
 BRIDGED_JUDGE_PORT = 9999
+# Worker threads running judge packet handlers (database updates) off the bridge event loop. 0 or None runs
+# them on the event loop itself, one at a time.
+BRIDGED_JUDGE_WORKERS = 4
+# Judge handshakes processed at once; the rest wait, so judges reconnecting together don't tie up every worker.
+BRIDGED_JUDGE_HANDSHAKES = 2
+# Pending connections the kernel holds for each bridge listener until they are accepted.
+BRIDGED_LISTEN_BACKLOG = 128
 BRIDGED_DJANGO_HOST = 'localhost'
 BRIDGED_DJANGO_PORT = 9998
+# Path of a Unix domain socket for the site to reach the bridge on instead of BRIDGED_DJANGO_HOST and
+# BRIDGED_DJANGO_PORT, when both run on the same host.
+BRIDGED_DJANGO_UNIX_SOCKET = None
+# Path of a Unix domain socket on which the bridge hands its connections over to a new bridge process started
+# with runbridged --take-over, so it can be restarted without judges disconnecting. None turns this off.
+BRIDGED_HANDOFF_SOCKET = None
+# Path of a file in which the bridge journals its queue, so that after a crash it can requeue submissions in
+# their old order and priority. Pending submissions are requeued from the database either way.
+BRIDGED_QUEUE_JOURNAL = None
+# Seconds between bridge statistics lines in the log, or None to turn them off.
+BRIDGED_STATS_INTERVAL = 60
 
 # Event Server configuration
 EVENT_DAEMON_USE = False
@@ -1,6 +1,8 @@
 from .base_server import BaseServer
+from .executor import PacketExecutor
 from .handler import Handler
 from .helpers import SizedPacketHandler, ZlibPacketHandler
+from .serializers import Serializer, JSONSerializer, PackedSerializer, PacketShape
 from .engines import *
 
 
@@ -1,24 +1,51 @@
+import errno
+import fcntl
 import logging
+import os
 import socket
+import stat
 import threading
 import time
 from collections import defaultdict, deque
-from heapq import heappush, heappop
+
+from .metrics import ServerMetrics
+from .timing_wheel import TimingWheel
 
 __author__ = 'Quantum'
 logger = logging.getLogger('event_socket_server')
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# The connection went away before it was accepted; move on to the next one.
+ACCEPT_RETRY = (errno.ECONNABORTED, errno.EPROTO, errno.EINTR)
+
+
+if hasattr(socket.socket, 'sendmsg'):
+    def send_chunks(sock, chunks):
+        return sock.sendmsg(chunks)
+else:
+    def send_chunks(sock, chunks):
+        # No writev here: coalesce into one send. Callers bound the batch size, so the copy stays small.
+        if len(chunks) == 1:
+            return sock.send(chunks[0])
+        return sock.send(''.join(chunk if isinstance(chunk, str) else str(chunk) for chunk in chunks))
 
 
 class SendMessage(object):
-    __slots__ = ('data', 'callback')
+    __slots__ = ('data', 'callback', 'offset')
 
     def __init__(self, data, callback):
         self.data = data
         self.callback = callback
+        self.offset = 0
+
+    def chunk(self):
+        return buffer(self.data, self.offset) if self.offset else self.data
+
+    def remaining(self):
+        return len(self.data) - self.offset
 
 
 class ScheduledJob(object):
-    __slots__ = ('time', 'func', 'args', 'kwargs', 'cancel', 'dispatched')
+    __slots__ = ('time', 'func', 'args', 'kwargs', 'cancel', 'dispatched', 'expires', 'bucket')
 
     def __init__(self, time, func, args, kwargs):
         self.time = time
@@ -27,42 +54,209 @@ class ScheduledJob(object):
         self.kwargs = kwargs
         self.cancel = False
         self.dispatched = False
+        self.expires = None
+        self.bucket = None
 
 
 class BaseServer(object):
-    def __init__(self, host, port, client):
-        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server.setblocking(0)
-        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server.bind((host, port))
+    read_size = 65536
+    # Connections the kernel queues up on each listener before they are accepted.
+    listen_backlog = 128
+    # Upper bounds on how much of the send queue is gathered into a single send call.
+    send_batch = 64
+    send_batch_bytes = 262144
+    # Try sending straight away when nothing is queued, instead of waiting for a writable event.
+    direct_send = False
+    # Granularity, in seconds, of scheduled jobs.
+    timer_resolution = 0.01
+    # Per-client send queue limits, in bytes. Reading from a client stops once its queue passes the high
+    # watermark, and resumes when it drains to the low one. A client that stays above the hard limit for
+    # send_hard_limit_grace seconds is disconnected. None disables either limit.
+    send_high_watermark = 1 << 20
+    send_low_watermark = 256 << 10
+    send_hard_limit = 16 << 20
+    send_hard_limit_grace = 10
+    # Seconds between statistics log lines, or None for none.
+    stats_interval = None
+    # Seconds a handoff waits for handlers and sends in progress to finish before going ahead anyway.
+    handoff_timeout = 10
+    # Whether the engine can pass its connections to another process, or take them over, at all.
+    supports_handoff = True
+
+    def __init__(self, host, port, client, read_size=None, executor=None, stats_interval=None,
+                 listen_backlog=None):
+        # Listening sockets, and the handler class for the connections each one accepts.
+        self._listeners = {}
+        self._unix_paths = {}
+        # With no host, the listeners are added later, or taken over from another process with restore.
+        self._server = self.add_listener(host, port, client) if host is not None else None
         self._stop = threading.Event()
         self._clients = set()
-        self._ClientClass = client
         self._send_queue = defaultdict(deque)
-        self._job_queue = []
+        self.counters = defaultdict(int)
+        self.metrics = ServerMetrics()
+        self._last_metrics = None
+        self._job_queue = TimingWheel(time.time(), self.timer_resolution)
         self._job_queue_lock = threading.Lock()
+        # Held by the event loop while it works on clients, and by other threads that touch them.
+        self._lock = threading.RLock()
+        self._read_holds = {}
+        # Calls handed to the event loop by other threads, and the pipe that wakes the loop up for them.
+        self._calls = deque()
+        self._loop_thread = None
+        self._wakeup_fd, self._wakeup_write_fd = os.pipe()
+        for fd in (self._wakeup_fd, self._wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._wakeup_pending = False
+        self._queued_bytes = {}
+        self._backlogged = set()
+        self._overflow_jobs = {}
+        # Set once the listeners and clients belong to another process, so shutting down leaves them alone.
+        self._handed_off = False
+        self.executor = executor
+        if read_size is not None:
+            self.read_size = read_size
+        if stats_interval is not None:
+            self.stats_interval = stats_interval
+        if listen_backlog is not None:
+            self.listen_backlog = listen_backlog
+
+    def add_listener(self, host, port, client):
+        """Also accepts connections on (host, port), handling them with client. Call before serve_forever.
+
+        With port None, host is the path of a Unix domain socket instead.
+        """
+        if port is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Left behind by a previous run that didn't shut down cleanly.
+            if os.path.exists(host) and stat.S_ISSOCK(os.stat(host).st_mode):
+                os.unlink(host)
+            sock.bind(host)
+            self._unix_paths[sock] = host
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+        sock.setblocking(0)
+        self._listeners[sock] = client
+        return sock
+
+    def _listen(self):
+        for sock in self._listeners:
+            sock.listen(self.listen_backlog)
+
+    def _close_listeners(self):
+        for sock in self._listeners:
+            sock.close()
+        for path in self._unix_paths.itervalues():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
     def _serve(self):
         raise NotImplementedError()
 
-    def _accept(self):
-        conn, address = self._server.accept()
+    def _accept(self, listener):
+        conn, address = listener.accept()
         conn.setblocking(0)
-        client = self._ClientClass(self, conn)
+        client = self._listeners[listener](self, conn)
         self._clients.add(client)
         return client
 
+    def _add_client(self, client):
+        # Starts watching a client that wasn't accepted through the event loop.
+        raise NotImplementedError()
+
+    def _stop_accepting(self):
+        raise NotImplementedError()
+
+    def _start_accepting(self):
+        raise NotImplementedError()
+
+    def _accept_all(self, listener):
+        """Accepts every connection waiting on listener, so a burst of them takes one event instead of one each."""
+        clients = []
+        while True:
+            try:
+                client = self._accept(listener)
+            except socket.error as e:
+                if e.errno in ACCEPT_RETRY:
+                    continue
+                if e.errno not in WOULD_BLOCK:
+                    # Most likely out of file descriptors: leave the rest queued until some are closed.
+                    logger.error('Failed to accept connection: %s', e)
+                    self.counters['accept-failure'] += 1
+                break
+            logger.debug('Accepting: %s', client.name)
+            clients.append(client)
+        if clients:
+            self.counters['accepted'] += len(clients)
+            self.metrics.accept_batch.add(len(clients))
+        return clients
+
+    def _in_loop(self):
+        return self._loop_thread is threading.current_thread()
+
+    def call_soon(self, func, *args):
+        """Runs func(*args) on the event loop thread, after the calls handed over before it. Thread-safe."""
+        self._calls.append((func, args))
+        self._wake()
+
+    def _call_in_loop(self, func, *args):
+        if self._in_loop():
+            func(*args)
+        else:
+            self.call_soon(func, *args)
+
+    def _wake(self):
+        if self._wakeup_pending or self._wakeup_write_fd is None:
+            return
+        self._wakeup_pending = True
+        try:
+            os.write(self._wakeup_write_fd, '\0')
+        except OSError as e:
+            # A full pipe will wake the loop just as well.
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def _handle_wakeup(self):
+        try:
+            while os.read(self._wakeup_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+        # Cleared before the calls run, so a call handed over after this point writes to the pipe again.
+        self._wakeup_pending = False
+
+    def _run_calls(self):
+        calls = self._calls
+        if not calls:
+            return
+        with self._lock:
+            while calls:
+                func, args = calls.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception('Error in call handed to the event loop: %r', func)
+
     def schedule(self, delay, func, *args, **kwargs):
         with self._job_queue_lock:
             job = ScheduledJob(time.time() + delay, func, args, kwargs)
-            heappush(self._job_queue, job)
-            return job
+            self._job_queue.add(job)
+        if not self._in_loop():
+            # The loop may be asleep until a later job is due.
+            self._wake()
+        return job
 
     def unschedule(self, job):
         with self._job_queue_lock:
             if job.dispatched or job.cancel:
                 return False
             job.cancel = True
+            self._job_queue.remove(job)
             return True
 
     def _register_write(self, client):
@@ -71,61 +265,194 @@ class BaseServer(object):
     def _register_read(self, client):
         raise NotImplementedError()
 
+    def _pause_reading(self, client):
+        if not self._in_loop():
+            self.call_soon(self._pause_reading, client)
+            return
+        with self._lock:
+            if client not in self._clients:
+                return
+            holds = self._read_holds[client] = self._read_holds.get(client, 0) + 1
+            if holds == 1:
+                self._set_reading(client, False)
+
+    def _resume_reading(self, client):
+        if not self._in_loop():
+            self.call_soon(self._resume_reading, client)
+            return
+        with self._lock:
+            if client not in self._read_holds:
+                return
+            self._read_holds[client] -= 1
+            if not self._read_holds[client]:
+                del self._read_holds[client]
+                self._set_reading(client, True)
+
+    def _set_reading(self, client, reading):
+        raise NotImplementedError()
+
+    def _is_reading(self, client):
+        return client not in self._read_holds
+
+    def _run_handler(self, client, func, *args):
+        if self.executor is None:
+            func(*args)
+        else:
+            self.executor.submit(client, func, *args)
+
+    def _set_queued(self, client, queued):
+        # Called with the lock held whenever the amount of data waiting to be sent to client changes.
+        if queued:
+            self._queued_bytes[client] = queued
+        else:
+            self._queued_bytes.pop(client, None)
+
+        if client in self._backlogged:
+            if self.send_low_watermark is None or queued <= self.send_low_watermark:
+                logger.info('Resuming reads from %s: %d bytes queued', client.name, queued)
+                self._backlogged.discard(client)
+                self._resume_reading(client)
+                self._run_handler(client, client.on_send_backlog, False)
+        elif self.send_high_watermark is not None and queued > self.send_high_watermark:
+            logger.info('Pausing reads from %s: %d bytes queued', client.name, queued)
+            self.counters['send-backlogged'] += 1
+            self._backlogged.add(client)
+            self._pause_reading(client)
+            self._run_handler(client, client.on_send_backlog, True)
+
+        if self.send_hard_limit is not None:
+            if queued > self.send_hard_limit:
+                if client not in self._overflow_jobs:
+                    self._overflow_jobs[client] = self.schedule(self.send_hard_limit_grace,
+                                                                self._check_overflow, client)
+            elif client in self._overflow_jobs:
+                self.unschedule(self._overflow_jobs.pop(client))
+
+    def _check_overflow(self, client):
+        with self._lock:
+            if self._overflow_jobs.pop(client, None) is None or client not in self._clients:
+                return
+            queued = self._queued_bytes.get(client, 0)
+            if queued > self.send_hard_limit:
+                logger.warning('Disconnecting %s: %d bytes queued for over %ss',
+                               client.name, queued, self.send_hard_limit_grace)
+                self.counters['send-overflow'] += 1
+                self._clean_up_client(client)
+
+    def _forget_send_state(self, client):
+        self._queued_bytes.pop(client, None)
+        self._backlogged.discard(client)
+        job = self._overflow_jobs.pop(client, None)
+        if job is not None:
+            self.unschedule(job)
+        self._read_holds.pop(client, None)
+
     def _clean_up_client(self, client, finalize=False):
         try:
             del self._send_queue[client.fileno()]
         except KeyError:
             pass
-        client.on_close()
+        self._forget_send_state(client)
+        self._run_handler(client, client.on_close)
         client._socket.close()
         if not finalize:
             self._clients.remove(client)
 
     def _dispatch_event(self):
-        t = time.time()
-        tasks = []
         with self._job_queue_lock:
-            while True:
-                dt = self._job_queue[0].time - t if self._job_queue else 1
-                if dt > 0:
-                    break
-                task = heappop(self._job_queue)
+            tasks = self._job_queue.advance(time.time())
+            for task in tasks:
                 task.dispatched = True
-                if not task.cancel:
-                    tasks.append(task)
+        if tasks:
+            self.metrics.scheduler_lag.add(self._job_queue.lag)
+        if self._job_queue.lag > self.timer_resolution * 10:
+            logger.debug('Scheduled jobs dispatched %.3fs late', self._job_queue.lag)
         for task in tasks:
             logger.debug('Dispatching event: %r(*%r, **%r)', task.func, task.args, task.kwargs)
             task.func(*task.args, **task.kwargs)
-        if not self._job_queue or dt > 1:
-            dt = 1
-        return dt
+        with self._job_queue_lock:
+            return self._job_queue.timeout(time.time())
+
+    @property
+    def scheduler_lag(self):
+        return self._job_queue.lag
 
     def _nonblock_read(self, client):
-        try:
-            data = client._socket.recv(1024)
-        except socket.error:
-            self._clean_up_client(client)
-        else:
-            logger.debug('Read from %s: %d bytes', client.name, len(data))
-            if not data:
+        # Drain the socket until it would block, so one readiness event consumes everything buffered.
+        read_size = self.read_size
+        while True:
+            data = None
+            try:
+                view = client._recv_buffer(read_size)
+                if view is None:
+                    data = client._socket.recv(read_size)
+                    size = len(data)
+                else:
+                    size = client._socket.recv_into(view)
+                    # The handler may need to resize its buffer, which it can't do with a view outstanding.
+                    del view
+            except socket.error as e:
+                if e.errno not in WOULD_BLOCK:
+                    self._clean_up_client(client)
+                return
+            logger.debug('Read from %s: %d bytes', client.name, size)
+            if not size:
                 self._clean_up_client(client)
-            else:
-                try:
+                return
+            client.bytes_received += size
+            self.metrics.bytes_in += size
+            try:
+                if data is None:
+                    client._recv_commit(size)
+                else:
                     client._recv_data(data)
-                except Exception:
-                    logger.exception('Client recv_data failure')
-                    self._clean_up_client(client)
+            except Exception:
+                logger.exception('Client recv_data failure')
+                self._clean_up_client(client)
+                return
+            if client not in self._clients:
+                # Closed by its own handler.
+                return
+            if not self._is_reading(client):
+                # Paused while handling what was just read; leave the rest in the kernel.
+                return
+
+    def _gather(self, queue):
+        chunks = []
+        size = 0
+        for message in queue:
+            remaining = message.remaining()
+            if chunks and (len(chunks) >= self.send_batch or size + remaining > self.send_batch_bytes):
+                break
+            chunks.append(message.chunk())
+            size += remaining
+        return chunks, size
 
     def _nonblock_write(self, client):
         fd = client.fileno()
         queue = self._send_queue[fd]
-        try:
-            top = queue[0]
-            cb = client._socket.send(top.data)
-            top.data = top.data[cb:]
-            logger.debug('Send to %s: %d bytes', client.name, cb)
-            if not top.data:
-                logger.debug('Finished sending: %s', client.name)
+        while queue:
+            chunks, size = self._gather(queue)
+            try:
+                sent = send_chunks(client._socket, chunks)
+            except socket.error as e:
+                if e.errno not in WOULD_BLOCK:
+                    self._clean_up_client(client)
+                return
+            logger.debug('Send to %s: %d bytes in %d messages', client.name, sent, len(chunks))
+            client.bytes_sent += sent
+            self.metrics.bytes_out += sent
+            self._set_queued(client, self._queued_bytes.get(client, 0) - sent)
+
+            short = sent < size
+            while queue:
+                top = queue[0]
+                remaining = top.remaining()
+                if sent < remaining:
+                    top.offset += sent
+                    break
+                sent -= remaining
+                queue.popleft()
                 if top.callback is not None:
                     logger.debug('Calling callback: %s: %r', client.name, top.callback)
                     try:
@@ -134,23 +461,278 @@ class BaseServer(object):
                         logger.exception('Client write callback failure')
                         self._clean_up_client(client)
                         return
-                queue.popleft()
-                if not queue:
-                    self._register_read(client)
-                    del self._send_queue[fd]
+                    if client not in self._clients:
+                        return
+
+            if short:
+                # The kernel buffer is full; wait for the next writable event.
+                return
+
+        logger.debug('Finished sending: %s', client.name)
+        self._register_read(client)
+        del self._send_queue[fd]
+
+    def _send_direct(self, client, message):
+        try:
+            sent = client._socket.send(message.data)
         except socket.error:
-            self._clean_up_client(client)
+            # Would block, or a real error which the event loop will run into and clean up after.
+            sent = 0
+        client.bytes_sent += sent
+        self.metrics.bytes_out += sent
+        if sent < len(message.data):
+            message.offset = sent
+            self.counters['send-direct-partial'] += 1
+            return False
+
+        self.counters['send-direct'] += 1
+        if message.callback is not None:
+            logger.debug('Calling callback: %s: %r', client.name, message.callback)
+            try:
+                message.callback()
+            except Exception:
+                logger.exception('Client write callback failure')
+                self._clean_up_client(client)
+        return True
 
     def send(self, client, data, callback=None):
         logger.debug('Writing %d bytes to client %s, callback: %s', len(data), client.name, callback)
-        self._send_queue[client.fileno()].append(SendMessage(data, callback))
-        self._register_write(client)
+        with self._lock:
+            if self._calls or not self._in_loop():
+                # Other threads hand their sends to the loop. Sends on the loop thread go after those already
+                # handed over, so that data reaches each client in the order send was called.
+                self.call_soon(self._send, client, data, callback)
+            else:
+                self._send(client, data, callback)
+
+    def _send(self, client, data, callback):
+        with self._lock:
+            if client not in self._clients:
+                logger.debug('Dropping %d bytes to closed client %s', len(data), client.name)
+                return
+            if self._handed_off:
+                # The connection belongs to the other process now; anything written here would garble it.
+                logger.debug('Dropping %d bytes to handed off client %s', len(data), client.name)
+                return
+            fd = client.fileno()
+            message = SendMessage(data, callback)
+            if not self._send_queue.get(fd):
+                if self.direct_send and self._send_direct(client, message):
+                    return
+                self._send_queue[fd].append(message)
+                self._register_write(client)
+            else:
+                # Already waiting for a writable event.
+                self._send_queue[fd].append(message)
+            self.counters['send-queued'] += 1
+            queued = self._queued_bytes.get(client, 0)
+            self.metrics.send_queue.add(queued)
+            self._set_queued(client, queued + message.remaining())
+
+    def hand_off(self, requester):
+        """Passes the listeners and connections of this server to the process at the other end of requester,
+        one of its clients, and then stops. Runs on the event loop.
+
+        New connections are left to queue up on the listeners, and clients are no longer read from. Once the
+        handlers and sends already under way are done, everything is sent over with handoff.send_handoff.
+        """
+        if not self.supports_handoff:
+            requester.close()
+            raise NotImplementedError('%s cannot hand off its connections' % self.__class__.__name__)
+        logger.info('Handing off to a new process')
+        try:
+            self._stop_accepting()
+        except NotImplementedError:
+            logger.error('%s cannot hand off its connections', self.__class__.__name__)
+            requester.close()
+            return
+        for client in list(self._clients):
+            if client is not requester:
+                self._pause_reading(client)
+        self._handoff_wait(requester, time.time() + self.handoff_timeout)
+
+    def _handoff_busy(self, requester):
+        if self._calls or self.executor is not None and not self.executor.idle():
+            return True
+        return any(queue for fd, queue in self._send_queue.iteritems() if fd != requester.fileno())
+
+    def _handoff_wait(self, requester, deadline):
+        if not self._handoff_busy(requester) and not self._close_unhandable(requester):
+            self._finish_handoff(requester)
+            return
+        if time.time() < deadline:
+            self.schedule(self.timer_resolution, self._handoff_wait, requester, deadline)
+            return
+        logger.warning('Handing off with work still in progress')
+        self._finish_handoff(requester)
+
+    def _close_unhandable(self, requester):
+        # Clients that can't be handed off are closed before anything else is, and their handlers waited for:
+        # closing one can change the state of the server that goes with the others. Returns whether any were.
+        closed = False
+        with self._lock:
+            for client in list(self._clients):
+                if client is not requester and client.handoff_state() is None:
+                    logger.info('Closing %s, which cannot be handed off', client.name)
+                    self._clean_up_client(client)
+                    closed = True
+        return closed
+
+    def _finish_handoff(self, requester):
+        from .handoff import send_handoff
+
+        with self._lock:
+            listeners = list(self._listeners)
+            clients = []
+            for client in list(self._clients):
+                if client is requester:
+                    continue
+                state = client.handoff_state()
+                if state is None:
+                    # Only when the handoff gave up waiting.
+                    logger.info('Closing %s, which cannot be handed off', client.name)
+                    self._clean_up_client(client)
+                    continue
+                client_unsent = ''.join(str(message.chunk())
+                                        for message in self._send_queue.get(client.fileno(), ()))
+                clients.append((client, state, client_unsent))
+
+            state = {
+                'server': self.handoff_state(),
+                'listeners': [{
+                    'handler': self._listeners[sock].__name__,
+                    'family': sock.family,
+                    'path': self._unix_paths.get(sock),
+                } for sock in listeners],
+                'clients': [{
+                    'handler': client.__class__.__name__,
+                    'family': client.socket.family,
+                    'state': client_state,
+                    'unsent': unsent.encode('base64'),
+                } for client, client_state, unsent in clients],
+            }
+            fds = [sock.fileno() for sock in listeners] + [client.fileno() for client, _, _ in clients]
+            try:
+                send_handoff(requester.socket, state, fds)
+            except Exception:
+                logger.exception('Handoff failed, carrying on')
+                requester.close()
+                self.handoff_failed()
+                self._start_accepting()
+                for client, _, _ in clients:
+                    self._resume_reading(client)
+                return
+            logger.info('Handed off %d listeners and %d connections', len(listeners), len(clients))
+            self._handed_off = True
+            self.stop()
+
+    def handoff_state(self):
+        """State of the server itself to carry over in a handoff, as something JSON can encode."""
+        return {}
+
+    def handoff_failed(self):
+        """Called when a handoff could not be sent and this server carries on."""
+        pass
+
+    def restore_state(self, state):
+        pass
+
+    def restore(self, state, fds, handlers):
+        """Takes over the listeners and connections that another process handed off, before serve_forever.
+
+        handlers are the handler classes the connections may use, which are matched up by name.
+        """
+        handlers = dict((handler.__name__, handler) for handler in handlers)
+        fds = iter(fds)
+        with self._lock:
+            for listener in state['listeners']:
+                sock = self._from_fd(next(fds), listener['family'])
+                if listener['handler'] not in handlers:
+                    logger.error('No handler %s for handed off listener, closing it', listener['handler'])
+                    sock.close()
+                    continue
+                self._listeners[sock] = handlers[listener['handler']]
+                if listener['path'] is not None:
+                    self._unix_paths[sock] = listener['path']
+                if self._server is None:
+                    self._server = sock
+
+            self.restore_state(state['server'])
+            for entry in state['clients']:
+                sock = self._from_fd(next(fds), entry['family'])
+                if entry['handler'] not in handlers:
+                    logger.error('No handler %s for handed off connection, closing it', entry['handler'])
+                    sock.close()
+                    continue
+                client = handlers[entry['handler']](self, sock)
+                self._clients.add(client)
+                self._add_client(client)
+                client.restore_state(entry['state'])
+                unsent = entry['unsent'].decode('base64')
+                if unsent:
+                    self._send(client, unsent, None)
+        logger.info('Took over %d listeners and %d connections', len(self._listeners), len(self._clients))
+
+    def _from_fd(self, fd, family):
+        # fromfd duplicates the descriptor, so the one received is closed.
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(0)
+        return sock
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'clients': len(self._clients),
+                'backlogged': len(self._backlogged),
+                'scheduler-lag': self._job_queue.lag,
+                'max-scheduler-lag': self._job_queue.max_lag,
+                'counters': dict(self.counters),
+                # Worst first, as [name, bytes] pairs: handler names need not be unique, or even set.
+                'queued-bytes': sorted((['%s' % (client.name,), queued] for client, queued in
+                                        self._queued_bytes.iteritems()), key=lambda item: -item[1]),
+                'listeners': [{
+                    'address': self._unix_paths.get(sock) or '%s:%d' % sock.getsockname()[:2],
+                    'handler': handler.__name__,
+                } for sock, handler in self._listeners.iteritems()],
+                'connections': [{
+                    'name': '%s' % (client.name,),
+                    'handler': client.__class__.__name__,
+                    'bytes-in': client.bytes_received,
+                    'bytes-out': client.bytes_sent,
+                    'queued': self._queued_bytes.get(client, 0),
+                } for client in self._clients],
+            }
+        stats['metrics'] = self.metrics.snapshot()
+        if self.executor is not None:
+            stats['executor'] = self.executor.stats()
+        return stats
+
+    def _log_stats(self):
+        now = time.time()
+        current = self.metrics.copy()
+        last, self._last_metrics = self._last_metrics, (now, current)
+        if last is not None:
+            logger.info('%s: %d clients, %s', self.__class__.__name__, len(self._clients),
+                        current.summary(last[1], now - last[0]))
+        self.schedule(self.stats_interval, self._log_stats)
 
     def stop(self):
         self._stop.set()
+        self._wake()
 
     def serve_forever(self):
-        self._serve()
+        self._loop_thread = threading.current_thread()
+        if self.stats_interval:
+            self._log_stats()
+        try:
+            self._serve()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            fds, self._wakeup_write_fd = (self._wakeup_fd, self._wakeup_write_fd), None
+            for fd in fds:
+                os.close(fd)
 
     def on_shutdown(self):
         pass
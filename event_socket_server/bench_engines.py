@@ -0,0 +1,253 @@
+import errno
+import heapq
+import multiprocessing
+import os
+import select
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+
+from .engines import engines
+from .executor import PacketExecutor
+from .helpers import ZlibPacketHandler, size_pack
+
+__author__ = 'Quantum'
+
+
+class EchoHandler(ZlibPacketHandler):
+    def packet(self, data):
+        self.send(data)
+
+
+def run_server(engine, workers, pipe):
+    executor = PacketExecutor(workers) if workers else None
+    server = engines[engine]('127.0.0.1', 0, EchoHandler, executor=executor)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    pipe.send(server._server.getsockname()[1])
+
+    pipe.recv()
+    start = os.times()
+    pipe.recv()
+    end = os.times()
+    stats = server.stats()
+    server.stop()
+    thread.join()
+    pipe.send({
+        'cpu': (end[0] - start[0]) + (end[1] - start[1]),
+        'loop-p99': stats['metrics']['loop']['p99'],
+    })
+
+
+class LoadClient(object):
+    def __init__(self, port, frame):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setblocking(0)
+        self.frame = frame
+        self.outgoing = ''
+        self.incoming = ''
+        self.sent = deque()
+        self.next_send = 0
+        self.writing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue(self, now):
+        self.outgoing += self.frame
+        self.sent.append(now)
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.outgoing)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return
+        self.outgoing = self.outgoing[sent:]
+
+    def replies(self):
+        """Reads what is available and returns the send times of the packets that were answered."""
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+            if not data:
+                raise IOError('Server closed the connection')
+            self.incoming += data
+        answered = []
+        offset = 0
+        # Frames are counted, not decompressed, so the client spends as little time as possible per packet.
+        while len(self.incoming) - offset >= size_pack.size:
+            length = size_pack.unpack_from(self.incoming, offset)[0]
+            if len(self.incoming) - offset - size_pack.size < length:
+                break
+            offset += size_pack.size + length
+            answered.append(self.sent.popleft())
+        self.incoming = self.incoming[offset:]
+        return answered
+
+
+def run_load(port, clients, frame, rate, depth, pipe, results):
+    """Connects clients connections, then drives them until end, recording the round trips of packets
+    sent after start. Both times come from the pipe once every load process is connected.
+
+    With a rate, each client sends that many packets per second no matter how the server keeps up.
+    Otherwise each client keeps depth packets in flight.
+    """
+    load = [LoadClient(port, frame) for i in xrange(clients)]
+    by_fd = dict((client.fileno(), client) for client in load)
+    poller = select.poll()
+    for client in load:
+        poller.register(client.fileno(), select.POLLIN)
+    pipe.send('connected')
+    start, end = pipe.recv()
+
+    now = time.time()
+    timers = []
+    for i, client in enumerate(load):
+        if rate:
+            # Spread the clients out over one interval so they don't all send at once.
+            client.next_send = now + float(i) / clients / rate
+            heapq.heappush(timers, (client.next_send, client.fileno()))
+        else:
+            for j in xrange(depth):
+                client.queue(now)
+
+    latencies = []
+    messages = 0
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        while timers and timers[0][0] <= now:
+            fd = heapq.heappop(timers)[1]
+            client = by_fd[fd]
+            client.queue(now)
+            client.next_send += 1.0 / rate
+            heapq.heappush(timers, (client.next_send, fd))
+
+        for client in load:
+            if client.outgoing and not client.writing:
+                client.flush()
+            if bool(client.outgoing) != client.writing:
+                client.writing = bool(client.outgoing)
+                poller.modify(client.fileno(), select.POLLIN | (select.POLLOUT if client.writing else 0))
+
+        timeout = min(end, timers[0][0]) - now if timers else end - now
+        for fd, event in poller.poll(max(0, timeout) * 1000):
+            client = by_fd[fd]
+            if event & select.POLLOUT:
+                client.flush()
+            if event & select.POLLIN:
+                received = time.time()
+                for sent in client.replies():
+                    if sent >= start:
+                        messages += 1
+                        latencies.append(received - sent)
+                    if not rate:
+                        client.queue(received)
+
+    for client in load:
+        client.sock.close()
+    results.put((messages, latencies))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchmark(engine, args, frame):
+    pipe, server_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(engine, args.workers, server_pipe))
+    server.start()
+    port = pipe.recv()
+
+    results = multiprocessing.Queue()
+    loaders = []
+    for i in xrange(args.processes):
+        clients = args.clients // args.processes + (i < args.clients % args.processes)
+        loader_pipe, child_pipe = multiprocessing.Pipe()
+        loader = multiprocessing.Process(target=run_load, args=(port, clients, frame, args.rate, args.depth,
+                                                                child_pipe, results))
+        loader.start()
+        loaders.append((loader, loader_pipe))
+
+    for loader, loader_pipe in loaders:
+        loader_pipe.recv()
+    start = time.time() + args.warmup
+    end = start + args.duration
+    for loader, loader_pipe in loaders:
+        loader_pipe.send((start, end))
+
+    time.sleep(max(0, start - time.time()))
+    pipe.send('start')
+    time.sleep(max(0, end - time.time()))
+    pipe.send('stop')
+
+    messages = 0
+    latencies = []
+    for loader, loader_pipe in loaders:
+        count, samples = results.get()
+        messages += count
+        latencies += samples
+    for loader, loader_pipe in loaders:
+        loader.join()
+    server_stats = pipe.recv()
+    server.join()
+
+    latencies.sort()
+    return {
+        'throughput': messages / args.duration,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'cpu': server_stats['cpu'] / messages if messages else 0.0,
+        'loop-p99': server_stats['loop-p99'],
+    }
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Drives an echo server on each engine with concurrent clients '
+                                                 'sending zlib packets, and compares the engines.')
+    parser.add_argument('-e', '--engine', action='append', choices=sorted(engines.keys()),
+                        help='engine to benchmark, may be repeated (default: all available)')
+    parser.add_argument('-c', '--clients', default=64, type=int, help='concurrent connections')
+    parser.add_argument('-s', '--size', default=256, type=int, help='payload bytes per packet')
+    parser.add_argument('-r', '--rate', default=0, type=float,
+                        help='packets per second per client (default: as fast as the server answers)')
+    parser.add_argument('-d', '--depth', default=1, type=int,
+                        help='packets in flight per client, without a rate')
+    parser.add_argument('-t', '--duration', default=5, type=float, help='seconds to measure for')
+    parser.add_argument('-w', '--warmup', default=1, type=float, help='seconds to run before measuring')
+    parser.add_argument('-j', '--processes', default=2, type=int, help='processes generating load')
+    parser.add_argument('--workers', default=0, type=int, help='run handlers on a PacketExecutor of this size')
+    parser.add_argument('--compressible', action='store_true', help='send text instead of random bytes')
+    args = parser.parse_args()
+
+    if args.compressible:
+        payload = ('judge packet %d ' * (args.size // 16 + 1))[:args.size]
+    else:
+        payload = os.urandom(args.size)
+    payload = zlib.compress(payload)
+    frame = size_pack.pack(len(payload)) + payload
+
+    print '%d clients, %d byte packets, %s' % (args.clients, args.size,
+                                              '%g/s each' % args.rate if args.rate else 'depth %d' % args.depth)
+    print '%-8s %12s %10s %10s %12s %14s' % ('engine', 'messages/s', 'p50 ms', 'p99 ms', 'cpu us/msg',
+                                            'loop p99 ms')
+    for engine in args.engine or sorted(engines.keys()):
+        result = benchmark(engine, args, frame)
+        print '%-8s %12.0f %10.3f %10.3f %12.1f %14.3f' % (engine, result['throughput'], result['p50'] * 1000,
+                                                          result['p99'] * 1000, result['cpu'] * 1e6,
+                                                          result['loop-p99'] * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import os
+import time
+
+from .helpers import SizedPacketHandler, size_pack
+
+__author__ = 'Quantum'
+
+
+class NullSocket(object):
+    def getpeername(self):
+        return 'benchmark'
+
+
+class CountingHandler(SizedPacketHandler):
+    def __init__(self, server, socket):
+        super(CountingHandler, self).__init__(server, socket)
+        self.packets = 0
+
+    def _packet(self, data):
+        self.packets += 1
+
+
+class LegacyCountingHandler(CountingHandler):
+    # The framing loop as it was before the receive buffer: string concatenation and slicing.
+    def _recv_buffer(self, size):
+        return None
+
+    def _recv_data(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._packetlen if self._packetlen else len(self._buffer) >= size_pack.size:
+            if self._packetlen:
+                data = self._buffer[:self._packetlen]
+                self._buffer = self._buffer[self._packetlen:]
+                self._packetlen = 0
+                self._packet(data)
+            else:
+                data = self._buffer[:size_pack.size]
+                self._buffer = self._buffer[size_pack.size:]
+                self._packetlen = size_pack.unpack(data)[0]
+
+
+def make_stream(frame_size, count):
+    frame = os.urandom(frame_size)
+    return (size_pack.pack(len(frame)) + frame) * count
+
+
+def feed(handler, stream, read_size):
+    # Mimics the server read loop: the kernel copies into the buffer, up to read_size bytes at a time.
+    if isinstance(handler, LegacyCountingHandler):
+        handler._buffer = ''
+        for i in xrange(0, len(stream), read_size):
+            handler._recv_data(stream[i:i + read_size])
+    else:
+        i = 0
+        while i < len(stream):
+            view = handler._recv_buffer(read_size)
+            chunk = stream[i:i + len(view)]
+            view[:len(chunk)] = chunk
+            del view
+            handler._recv_commit(len(chunk))
+            i += len(chunk)
+
+
+def run(handler_class, frame_size, count, read_size):
+    stream = make_stream(frame_size, count)
+    handler = handler_class(None, NullSocket())
+    start = time.time()
+    feed(handler, stream, read_size)
+    elapsed = time.time() - start
+    assert handler.packets == count
+    return elapsed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measures per-packet framing cost of SizedPacketHandler.')
+    parser.add_argument('-r', '--read-size', action='append', type=int,
+                        help='bytes per simulated read, may be repeated (default: 1024 and 65536)')
+    parser.add_argument('-s', '--frame-size', action='append', type=int,
+                        help='payload bytes per frame, may be repeated (default: 64, 4096, 65536, 1048576)')
+    parser.add_argument('-b', '--bytes', default=32 * 1024 * 1024, type=int,
+                        help='total payload bytes per run')
+    args = parser.parse_args()
+
+    print '%10s %10s %8s %14s %14s' % ('frame', 'read', 'packets', 'legacy us/pkt', 'buffer us/pkt')
+    for read_size in args.read_size or [1024, 65536]:
+        for frame_size in args.frame_size or [64, 4096, 65536, 1048576]:
+            count = max(1, args.bytes // (frame_size + size_pack.size))
+            legacy = run(LegacyCountingHandler, frame_size, count, read_size)
+            current = run(CountingHandler, frame_size, count, read_size)
+            print '%10d %10d %8d %14.2f %14.2f' % (frame_size, read_size, count,
+                                                  legacy / count * 1e6, current / count * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import time
+
+from .bench_zlib import judge_packets
+from .helpers import StreamCodec, size_pack
+from .serializers import JSONSerializer, PackedSerializer, PacketShape
+
+__author__ = 'Quantum'
+TIMER = [time.clock, time.time][os.name == 'nt']
+
+
+def infer_shapes(packets):
+    # One shape per distinct packet layout, much like a hand-written table for the hot packets would be.
+    shapes = {}
+    for packet in packets:
+        layout = (packet['name'], tuple(sorted(packet)))
+        if layout in shapes:
+            continue
+        fields = sorted(key for key in packet if key != 'name')
+        shapes[layout] = PacketShape(len(shapes) + 1, packet['name'],
+                                     ints=[key for key in fields if type(packet[key]) in (int, long)],
+                                     floats=[key for key in fields if type(packet[key]) is float],
+                                     strings=[key for key in fields if isinstance(packet[key], basestring)])
+    return shapes.values()
+
+
+def run(serializer, packets, raw_threshold):
+    start = TIMER()
+    frames = [serializer.dumps(packet) for packet in packets]
+    encode = TIMER() - start
+    start = TIMER()
+    for frame in frames:
+        serializer.loads(frame)
+    decode = TIMER() - start
+
+    codec = StreamCodec()
+    compressed = sum(len(frame if len(frame) < raw_threshold else codec.compress(frame)) for frame in frames)
+    overhead = size_pack.size * len(frames)
+    return encode, decode, sum(len(frame) for frame in frames) + overhead, compressed + overhead
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compares JSON against the packed serializer on judge traffic.')
+    parser.add_argument('-s', '--submissions', default=200, type=int)
+    parser.add_argument('-c', '--cases', default=50, type=int, help='test cases per submission')
+    parser.add_argument('-t', '--raw-threshold', default=64, type=int)
+    args = parser.parse_args()
+
+    packets = list(judge_packets(args.submissions, args.cases))
+    packed = PackedSerializer('packed-bench', infer_shapes(packets))
+    for packet in packets[:1000]:
+        assert packed.loads(packed.dumps(packet)) == packet
+
+    print '%d packets' % len(packets)
+    print '%-8s %12s %12s %12s %14s' % ('format', 'encode us', 'decode us', 'wire bytes', 'zlib stream')
+    for name, serializer in [('json', JSONSerializer()), ('packed', packed)]:
+        encode, decode, wire, compressed = run(serializer, packets, args.raw_threshold)
+        print '%-8s %12.2f %12.2f %12d %14d' % (name, encode / len(packets) * 1e6, decode / len(packets) * 1e6,
+                                                wire, compressed)
+
+if __name__ == '__main__':
+    main()
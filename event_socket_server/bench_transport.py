@@ -0,0 +1,114 @@
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from . import get_preferred_engine
+from .engines import engines
+from .helpers import ZlibPacketHandler, size_pack
+from .serializers import JSONSerializer
+
+__author__ = 'Quantum'
+
+
+class SubmissionHandler(ZlibPacketHandler):
+    # Answers like DjangoHandler does, without a judge behind it.
+    serializer = JSONSerializer()
+
+    def packet(self, data):
+        packet = self._parse(data)
+        self.send({'name': 'submission-received', 'submission-id': packet['submission-id']},
+                  lambda: self.server.schedule(0, self.close))
+
+
+def run_server(engine, host, port, pipe):
+    server = engines[engine](host, port, SubmissionHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    pipe.send(port if port is None else server._server.getsockname()[1])
+    pipe.recv()
+    server.stop()
+    thread.join()
+
+
+def request(family, address, payload):
+    # The same exchange as judgeapi.judge_request: one connection per request.
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    sock.sendall(payload)
+    reader = sock.makefile('r', -1)
+    length = size_pack.unpack(reader.read(size_pack.size))[0]
+    reply = json.loads(reader.read(length).decode('zlib'))
+    reader.close()
+    sock.close()
+    return reply
+
+
+def measure(engine, host, port, requests, warmup, source):
+    pipe, server_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(engine, host, port, server_pipe))
+    server.start()
+    port = pipe.recv()
+    if port is None:
+        family, address = socket.AF_UNIX, host
+    else:
+        family, address = socket.AF_INET, (host, port)
+    # The engine starts listening on its own thread.
+    while True:
+        probe = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except socket.error:
+            time.sleep(0.01)
+        else:
+            break
+        finally:
+            probe.close()
+
+    latencies = []
+    try:
+        for id in xrange(warmup + requests):
+            output = json.dumps({'name': 'submission-request', 'submission-id': id, 'problem-id': 'aplusb',
+                                 'language': 'PY2', 'source': source}, separators=(',', ':')).encode('zlib')
+            start = time.time()
+            reply = request(family, address, size_pack.pack(len(output)) + output)
+            if id >= warmup:
+                latencies.append(time.time() - start)
+            assert reply['submission-id'] == id
+    finally:
+        pipe.send('stop')
+        server.join()
+    latencies.sort()
+    return latencies
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compares TCP against Unix domain sockets for site requests '
+                                                 'to the bridge, a new connection per submission.')
+    preferred = get_preferred_engine()
+    parser.add_argument('-e', '--engine', choices=sorted(engines.keys()),
+                        default=next(name for name, engine in engines.iteritems() if engine is preferred))
+    parser.add_argument('-n', '--requests', default=5000, type=int)
+    parser.add_argument('-w', '--warmup', default=200, type=int)
+    parser.add_argument('-s', '--source-size', default=2048, type=int, help='bytes of source code per submission')
+    args = parser.parse_args()
+
+    source = ('print sum(map(int, raw_input().split()))\n' * (args.source_size // 40 + 1))[:args.source_size]
+    path = os.path.join(tempfile.mkdtemp(), 'bridge.sock')
+    print '%d submissions on %s' % (args.requests, args.engine)
+    print '%-6s %10s %10s %10s %10s' % ('', 'mean us', 'p50 us', 'p99 us', 'req/s')
+    for name, host, port in [('tcp', '127.0.0.1', 0), ('unix', path, None)]:
+        latencies = measure(args.engine, host, port, args.requests, args.warmup, source)
+        total = sum(latencies)
+        print '%-6s %10.1f %10.1f %10.1f %10.0f' % (name, total / len(latencies) * 1e6,
+                                                    latencies[len(latencies) // 2] * 1e6,
+                                                    latencies[int(len(latencies) * 0.99)] * 1e6,
+                                                    len(latencies) / total)
+    os.rmdir(os.path.dirname(path))
+
+if __name__ == '__main__':
+    main()
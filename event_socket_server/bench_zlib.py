@@ -0,0 +1,89 @@
+import json
+import os
+import random
+import time
+import zlib
+
+from .helpers import StreamCodec, size_pack
+
+__author__ = 'Quantum'
+TIMER = [time.clock, time.time][os.name == 'nt']
+
+
+def judge_packets(submissions, cases):
+    # Roughly what a judge sends the bridge while grading, plus its pings.
+    rng = random.Random(0)
+    for id in xrange(1, submissions + 1):
+        yield {'name': 'submission-acknowledged', 'submission-id': id}
+        yield {'name': 'grading-begin', 'submission-id': id}
+        for position in xrange(1, cases + 1):
+            yield {'name': 'test-case-status', 'submission-id': id, 'position': position,
+                   'status': rng.choice([0, 0, 0, 1, 4]), 'time': round(rng.uniform(0, 2), 6),
+                   'memory': rng.randint(1000, 262144), 'points': rng.choice([0.0, 5.0]),
+                   'total-points': 5.0, 'output': rng.choice(['', '', 'wrong answer on line %d' % position]),
+                   'feedback': ''}
+            if position % 10 == 0:
+                now = time.time()
+                yield {'name': 'ping-response', 'when': now, 'time': now, 'load': rng.uniform(0, 4)}
+        yield {'name': 'grading-end', 'submission-id': id}
+
+
+def vocabulary(packets):
+    # One packet of each kind is a fair stand-in for a protocol dictionary.
+    seen = {}
+    for packet in packets:
+        seen.setdefault(packet['name'], json.dumps(packet, separators=(',', ':')))
+    return ''.join(seen.values())
+
+
+def legacy(payloads):
+    start = TIMER()
+    frames = [zlib.compress(payload) for payload in payloads]
+    encode = TIMER() - start
+    start = TIMER()
+    for frame in frames:
+        zlib.decompress(frame)
+    decode = TIMER() - start
+    return encode, decode, sum(len(frame) + size_pack.size for frame in frames)
+
+
+def stream(payloads, dictionary=None, raw_threshold=64):
+    sender, receiver = StreamCodec(dictionary), StreamCodec(dictionary)
+    start = TIMER()
+    frames = [(True, payload) if len(payload) < raw_threshold else (False, sender.compress(payload))
+              for payload in payloads]
+    encode = TIMER() - start
+    start = TIMER()
+    for raw, frame in frames:
+        if not raw:
+            receiver.decompress(frame)
+    decode = TIMER() - start
+    return encode, decode, sum(len(frame) + size_pack.size for raw, frame in frames)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compares per-packet zlib against negotiated zlib streams.')
+    parser.add_argument('-s', '--submissions', default=200, type=int)
+    parser.add_argument('-c', '--cases', default=50, type=int, help='test cases per submission')
+    parser.add_argument('-t', '--raw-threshold', default=64, type=int)
+    args = parser.parse_args()
+
+    packets = list(judge_packets(args.submissions, args.cases))
+    payloads = [json.dumps(packet, separators=(',', ':')) for packet in packets]
+    dictionary = vocabulary(packets)
+    raw_bytes = sum(len(payload) + size_pack.size for payload in payloads)
+
+    print '%d packets, %d bytes uncompressed' % (len(payloads), raw_bytes)
+    print '%-22s %12s %12s %12s %8s' % ('mode', 'encode us', 'decode us', 'wire bytes', 'ratio')
+    for name, result in [
+        ('per-packet (legacy)', legacy(payloads)),
+        ('stream', stream(payloads, raw_threshold=args.raw_threshold)),
+        ('stream + dictionary', stream(payloads, dictionary, args.raw_threshold)),
+    ]:
+        encode, decode, wire = result
+        print '%-22s %12.2f %12.2f %12d %8.3f' % (name, encode / len(payloads) * 1e6,
+                                                  decode / len(payloads) * 1e6, wire, wire / float(raw_bytes))
+
+if __name__ == '__main__':
+    main()
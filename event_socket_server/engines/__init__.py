@@ -11,7 +11,15 @@ if hasattr(select, 'poll'):
     engines['poll'] = PollServer
 
 if hasattr(select, 'epoll'):
-    from .epoll_server import EpollServer
+    from .epoll_server import EpollServer, EpollEdgeServer
     engines['epoll'] = EpollServer
+    engines['epoll-et'] = EpollEdgeServer
+
+try:
+    from .asyncio_server import AsyncioServer
+except ImportError:
+    pass
+else:
+    engines['asyncio'] = AsyncioServer
 
 del select
\ No newline at end of file
@@ -0,0 +1,203 @@
+import logging
+import time
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from ..base_server import BaseServer
+
+__author__ = 'Quantum'
+logger = logging.getLogger('event_socket_server')
+
+
+class ClientProtocol(asyncio.Protocol):
+    def __init__(self, server, listener):
+        self.server = server
+        self.listener = listener
+        self.client = None
+        self.transport = None
+        # Send callbacks waiting for the transport's buffer to drain, in order.
+        self.callbacks = deque()
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Pause as soon as anything is buffered, so callbacks run only once their data reaches the kernel.
+        transport.set_write_buffer_limits(high=0)
+        self.client = self.server._accept_protocol(self)
+
+    def data_received(self, data):
+        client = self.client
+        if client is None:
+            return
+        logger.debug('Read from %s: %d bytes', client.name, len(data))
+        start = time.time()
+        client.bytes_received += len(data)
+        self.server.metrics.bytes_in += len(data)
+        try:
+            client._recv_data(data)
+        except Exception:
+            logger.exception('Client recv_data failure')
+            self.server._clean_up_client(client)
+        # There is no loop iteration to time here, so each delivery of data counts as one.
+        self.server.metrics.iteration(start, 1)
+
+    def connection_lost(self, exc):
+        if self.client is not None:
+            logger.debug('Client closed: %s', self.client.name)
+            self.server._clean_up_client(self.client)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.client is not None:
+            self.server._set_queued(self.client, 0)
+        while self.callbacks and self.client is not None:
+            self.server._run_callback(self.client, self.callbacks.popleft())
+
+
+class AsyncioServer(BaseServer):
+    """Runs the BaseServer contract on an asyncio (or trollius) event loop.
+
+    Calls from other threads reach the loop through call_soon_threadsafe rather than the
+    server's wakeup pipe. The loop owns the listening sockets and transports, so connections
+    can't be handed off to another process or taken over from one.
+    """
+    supports_handoff = False
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncioServer, self).__init__(*args, **kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._protocols = {}
+        self._accepting = None
+        self._timer = None
+
+    def call_soon(self, func, *args):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _wake(self):
+        # call_soon_threadsafe wakes the loop itself.
+        pass
+
+    def _accept_protocol(self, protocol):
+        self._accepting = protocol
+        try:
+            return self._accept(protocol.listener)
+        finally:
+            self._accepting = None
+
+    def _accept(self, listener):
+        protocol = self._accepting
+        client = self._listeners[listener](self, protocol.transport.get_extra_info('socket'))
+        logger.debug('Accepting: %s', client.name)
+        self._clients.add(client)
+        self._protocols[client] = protocol
+        return client
+
+    def _clean_up_client(self, client, finalize=False):
+        if not self._in_loop() and not finalize:
+            self._call_in_loop(self._clean_up_client, client)
+            return
+        protocol = self._protocols.pop(client, None)
+        if protocol is None:
+            return
+        logger.debug('Cleaning up client: %s, finalize: %d', client.name, finalize)
+        protocol.client = None
+        self._forget_send_state(client)
+        self._run_handler(client, client.on_close)
+        protocol.transport.close()
+        if not finalize:
+            self._clients.remove(client)
+
+    def _set_reading(self, client, reading):
+        protocol = self._protocols[client]
+        if reading:
+            protocol.transport.resume_reading()
+        else:
+            protocol.transport.pause_reading()
+
+    def _run_callback(self, client, callback):
+        logger.debug('Calling callback: %s: %r', client.name, callback)
+        try:
+            callback()
+        except Exception:
+            logger.exception('Client write callback failure')
+            self._clean_up_client(client)
+
+    def _write(self, client, data, callback):
+        protocol = self._protocols.get(client)
+        if protocol is None:
+            logger.debug('Dropping %d bytes to closed client %s', len(data), client.name)
+            return
+        queued = protocol.transport.get_write_buffer_size()
+        protocol.transport.write(data)
+        client.bytes_sent += len(data)
+        self.metrics.bytes_out += len(data)
+        if protocol.paused:
+            self.counters['send-queued'] += 1
+            self.metrics.send_queue.add(queued)
+            if callback is not None:
+                protocol.callbacks.append(callback)
+            # The transport only tells us when its buffer is empty again, so with this engine reads
+            # resume once everything has drained rather than at the low watermark.
+            self._set_queued(client, protocol.transport.get_write_buffer_size())
+        else:
+            self.counters['send-direct'] += 1
+            if callback is not None:
+                self._run_callback(client, callback)
+
+    def send(self, client, data, callback=None):
+        logger.debug('Writing %d bytes to client %s, callback: %s', len(data), client.name, callback)
+        # Always go through the loop's queue, even from the loop thread, so that writes keep the
+        # order in which they were sent across all threads.
+        self.call_soon(self._write, client, data, callback)
+
+    def schedule(self, delay, func, *args, **kwargs):
+        job = super(AsyncioServer, self).schedule(delay, func, *args, **kwargs)
+        # The new job may be due before the armed timer fires.
+        self._call_in_loop(self._arm_timer)
+        return job
+
+    def _arm_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        with self._job_queue_lock:
+            timeout = self._job_queue.timeout(time.time())
+        self._timer = self._loop.call_later(timeout, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        try:
+            self._dispatch_event()
+        finally:
+            self._arm_timer()
+
+    def stop(self):
+        super(AsyncioServer, self).stop()
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _serve(self):
+        self._listen()
+        servers = [self._loop.run_until_complete(self._loop.create_server(
+            lambda listener=listener: ClientProtocol(self, listener), sock=listener, backlog=self.listen_backlog))
+            for listener in self._listeners]
+        self._arm_timer()
+        try:
+            if not self._stop.is_set():
+                self._loop.run_forever()
+        finally:
+            logger.info('Shutting down server')
+            self.on_shutdown()
+            for client in list(self._clients):
+                self._clean_up_client(client, True)
+            for server in servers:
+                server.close()
+            self._close_listeners()
+            self._loop.close()
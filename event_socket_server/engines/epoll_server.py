@@ -1,5 +1,7 @@
+import logging
 import select
 __author__ = 'Quantum'
+logger = logging.getLogger('event_socket_server')
 
 if not hasattr(select, 'epoll'):
     raise ImportError('System does not support epoll')
@@ -14,3 +16,52 @@ class EpollServer(PollServer):
     POLLOUT = select.EPOLLOUT
     POLL_CLOSE = select.EPOLLHUP | select.EPOLLERR
     NEED_CLOSE = True
+    TIMEOUT_SCALE = 1
+
+
+# Missing from Python 2's select module.
+EPOLLRDHUP = getattr(select, 'EPOLLRDHUP', 0x2000)
+
+
+class EpollEdgeServer(EpollServer):
+    """Registers each client once, edge-triggered, for both reading and writing.
+
+    Every edge is handled by reading and writing until the socket would block, so there is no write
+    interest to toggle: epoll_ctl is only called on accept and close. Reads paused for a client are
+    picked up again by a drain when they resume, since no further edge comes for data already buffered.
+    """
+    CLIENT = select.EPOLLIN | select.EPOLLOUT | EPOLLRDHUP | select.EPOLLET
+    READABLE = select.EPOLLIN | EPOLLRDHUP
+    direct_send = True
+
+    def _register_client(self, fd):
+        self._poll.register(fd, self.CLIENT)
+
+    def _register_write(self, client):
+        # A send only queues after the socket stopped taking data, so an edge will follow once it drains.
+        pass
+
+    def _register_read(self, client):
+        pass
+
+    def _set_reading(self, client, reading):
+        logger.debug('%s reading: %s', 'Resumed' if reading else 'Paused', client.name)
+        if reading:
+            self.call_soon(self._drain, client)
+
+    def _drain(self, client):
+        if client in self._clients and self._is_reading(client):
+            self._nonblock_read(client)
+
+    def _client_event(self, client, event):
+        logger.debug('Client active: %s, events: %#x', client.name, event)
+        # Read first even on a hangup, so whatever the client sent before closing is still handled.
+        if event & self.READABLE and self._is_reading(client):
+            self._nonblock_read(client)
+        if client not in self._clients:
+            return
+        if event & self.POLL_CLOSE:
+            logger.debug('Client closed: %s', client.name)
+            self._clean_up_client(client)
+        elif event & self.POLLOUT and self._send_queue.get(client.fileno()):
+            self._nonblock_write(client)
@@ -1,7 +1,7 @@
 import errno
 import select
 import logging
-import threading
+import time
 from ..base_server import BaseServer
 
 __author__ = 'Quantum'
@@ -19,25 +19,41 @@ class PollServer(BaseServer):
     POLLOUT = select.POLLOUT
     POLL_CLOSE = select.POLLERR | select.POLLHUP
     NEED_CLOSE = False
+    # poll() takes its timeout in milliseconds, epoll() in seconds.
+    TIMEOUT_SCALE = 1000
+    direct_send = True
 
     def __init__(self, *args, **kwargs):
         super(PollServer, self).__init__(*args, **kwargs)
         self._poll = self.poll()
         self._fdmap = {}
-        self._server_fd = self._server.fileno()
-        self._close_lock = threading.RLock()
+        self._listener_fds = {}
+
+    def _modify(self, client, writing):
+        mask = self.WRITE if writing else self.READ
+        if not self._is_reading(client):
+            mask &= ~self.POLLIN
+        self.counters['poll-modify'] += 1
+        self._poll.modify(client.fileno(), mask)
 
     def _register_write(self, client):
         logger.debug('On write mode: %s', client.name)
-        self._poll.modify(client.fileno(), self.WRITE)
+        self._modify(client, True)
 
     def _register_read(self, client):
         logger.debug('On read mode: %s', client.name)
-        self._poll.modify(client.fileno(), self.READ)
+        self._modify(client, False)
+
+    def _set_reading(self, client, reading):
+        logger.debug('%s reading: %s', 'Resumed' if reading else 'Paused', client.name)
+        self._modify(client, bool(self._send_queue.get(client.fileno())))
 
     def _clean_up_client(self, client, finalize=False):
         logger.debug('Taking close lock: cleanup')
-        with self._close_lock:
+        with self._lock:
+            if not finalize and client not in self._clients:
+                # Already closed from another thread.
+                return
             logger.debug('Cleaning up client: %s, finalize: %d', client.name, finalize)
             fd = client.fileno()
             try:
@@ -50,46 +66,69 @@ class PollServer(BaseServer):
             del self._fdmap[fd]
             super(PollServer, self)._clean_up_client(client, finalize)
 
+    def _add_client(self, client):
+        fd = client.fileno()
+        self._register_client(fd)
+        self._fdmap[fd] = client
+
+    def _stop_accepting(self):
+        for fd in self._listener_fds:
+            self._poll.unregister(fd)
+        self._listener_fds.clear()
+
+    def _start_accepting(self):
+        for sock in self._listeners:
+            self._listener_fds[sock.fileno()] = sock
+            self._poll.register(sock.fileno(), self.POLLIN)
+
+    def _register_client(self, fd):
+        self._poll.register(fd, self.READ)
+
+    def _client_event(self, client, event):
+        if event & self.POLL_CLOSE:
+            logger.debug('Client closed: %s', client.name)
+            self._clean_up_client(client)
+            return
+        logger.debug('Client active: %s, read: %d, write: %d', client.name, event & self.POLLIN, event & self.POLLOUT)
+        if event & self.POLLIN:
+            logger.debug('Non-blocking read on client: %s', client.name)
+            self._nonblock_read(client)
+        # Might be closed in the read handler.
+        if event & self.POLLOUT and client in self._clients:
+            logger.debug('Non-blocking write on client: %s', client.name)
+            self._nonblock_write(client)
+
     def _serve(self):
-        self._server.listen(16)
-        self._poll.register(self._server_fd, self.POLLIN)
+        self._listen()
+        self._start_accepting()
+        self._poll.register(self._wakeup_fd, self.POLLIN)
         try:
             while not self._stop.is_set():
-                for fd, event in self._poll.poll(self._dispatch_event()):
-                    if fd == self._server_fd:
-                        client = self._accept()
-                        logger.debug('Accepting: %s', client.name)
-                        fd = client.fileno()
-                        self._poll.register(fd, self.READ)
-                        self._fdmap[fd] = client
-                    elif event & self.POLL_CLOSE:
-                        logger.debug('Client closed: %s', self._fdmap[fd].name)
-                        self._clean_up_client(self._fdmap[fd])
+                events = self._poll.poll(self._dispatch_event() * self.TIMEOUT_SCALE)
+                start = time.time()
+                for fd, event in events:
+                    if fd in self._listener_fds:
+                        with self._lock:
+                            for client in self._accept_all(self._listener_fds[fd]):
+                                self._add_client(client)
+                    elif fd == self._wakeup_fd:
+                        self._handle_wakeup()
                     else:
                         logger.debug('Taking close lock: event loop')
-                        with self._close_lock:
-                            try:
-                                client = self._fdmap[fd]
-                            except KeyError:
-                                pass
-                            else:
-                                logger.debug('Client active: %s, read: %d, write: %d',
-                                             client.name,
-                                             event & self.POLLIN,
-                                             event & self.POLLOUT)
-                                if event & self.POLLIN:
-                                    logger.debug('Non-blocking read on client: %s', client.name)
-                                    self._nonblock_read(client)
-                                # Might be closed in the read handler.
-                                if event & self.POLLOUT and fd in self._fdmap:
-                                    logger.debug('Non-blocking write on client: %s', client.name)
-                                    self._nonblock_write(client)
+                        with self._lock:
+                            client = self._fdmap.get(fd)
+                            if client is not None:
+                                self._client_event(client, event)
+                self._run_calls()
+                self.metrics.iteration(start, len(events))
         finally:
             logger.info('Shutting down server')
-            self.on_shutdown()
-            for client in self._clients:
-                self._clean_up_client(client, True)
-            self._poll.unregister(self._server_fd)
+            self._stop_accepting()
+            self._poll.unregister(self._wakeup_fd)
+            if not self._handed_off:
+                self.on_shutdown()
+                for client in self._clients:
+                    self._clean_up_client(client, True)
+                self._close_listeners()
             if self.NEED_CLOSE:
                 self._poll.close()
-            self._server.close()
@@ -1,4 +1,5 @@
 import select
+import time
 from ..base_server import BaseServer
 __author__ = 'Quantum'
 
@@ -6,7 +7,7 @@ __author__ = 'Quantum'
 class SelectServer(BaseServer):
     def __init__(self, *args, **kwargs):
         super(SelectServer, self).__init__(*args, **kwargs)
-        self._reads = set([self._server])
+        self._reads = set([self._wakeup_fd])
         self._writes = set()
 
     def _register_write(self, client):
@@ -15,33 +16,64 @@ class SelectServer(BaseServer):
     def _register_read(self, client):
         self._writes.remove(client)
 
+    def _add_client(self, client):
+        self._reads.add(client)
+
+    def _stop_accepting(self):
+        self._reads.difference_update(self._listeners)
+
+    def _start_accepting(self):
+        self._reads.update(self._listeners)
+
+    def _set_reading(self, client, reading):
+        if reading:
+            self._reads.add(client)
+        else:
+            self._reads.discard(client)
+
     def _clean_up_client(self, client, finalize=False):
-        self._writes.discard(client)
-        self._reads.remove(client)
-        super(SelectServer, self)._clean_up_client(client, finalize)
+        with self._lock:
+            if not finalize and client not in self._clients:
+                # Already closed from another thread.
+                return
+            self._writes.discard(client)
+            self._reads.discard(client)
+            super(SelectServer, self)._clean_up_client(client, finalize)
 
     def _serve(self, select=select.select):
-        self._server.listen(16)
+        self._listen()
+        self._start_accepting()
         try:
             while not self._stop.is_set():
-                r, w, x = select(self._reads, self._writes, self._reads, self._dispatch_event())
-                for s in r:
-                    if s is self._server:
-                        self._reads.add(self._accept())
-                    else:
-                        self._nonblock_read(s)
-
-                for client in w:
-                    self._nonblock_write(client)
-
-                for s in x:
-                    s.close()
-                    if s is self._server:
-                        raise RuntimeError('Server is in exceptional condition')
-                    else:
-                        self._clean_up_client(s)
+                timeout = self._dispatch_event()
+                with self._lock:
+                    reads, writes = list(self._reads), list(self._writes)
+                r, w, x = select(reads, writes, reads, timeout)
+                start = time.time()
+                with self._lock:
+                    for s in r:
+                        if s in self._listeners:
+                            self._reads.update(self._accept_all(s))
+                        elif s == self._wakeup_fd:
+                            self._handle_wakeup()
+                        elif s in self._clients:
+                            self._nonblock_read(s)
+
+                    for client in w:
+                        if client in self._clients:
+                            self._nonblock_write(client)
+
+                    for s in x:
+                        if s in self._listeners:
+                            s.close()
+                            raise RuntimeError('Server is in exceptional condition')
+                        elif s in self._clients:
+                            self._clean_up_client(s)
+                    self._run_calls()
+                self.metrics.iteration(start, len(r) + len(w) + len(x))
         finally:
-            self.on_shutdown()
-            for client in self._clients:
-                self._clean_up_client(client, True)
-            self._server.close()
\ No newline at end of file
+            if not self._handed_off:
+                self.on_shutdown()
+                for client in self._clients:
+                    self._clean_up_client(client, True)
+                self._close_listeners()
\ No newline at end of file
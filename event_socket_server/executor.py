@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+__author__ = 'Quantum'
+logger = logging.getLogger('event_socket_server')
+
+
+class PacketExecutor(object):
+    """Runs handler code for a server on a fixed pool of worker threads.
+
+    Work for one connection runs strictly in submission order and never on two workers at once;
+    different connections take turns. When a connection has backlog tasks waiting, the server
+    stops reading from it until the workers bring it back down to half of that.
+    """
+
+    def __init__(self, workers=4, backlog=64):
+        self.workers = workers
+        self.backlog = backlog
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._ready = Queue()
+        self._pending = {}
+        self._paused = set()
+        self._threads = []
+
+        self.queued = 0
+        self.max_queued = 0
+        self.tasks = 0
+        self.total_wait = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name='PacketExecutor-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, client, func, *args):
+        with self._lock:
+            queue = self._pending.get(client)
+            if queue is None:
+                queue = self._pending[client] = deque()
+                self._ready.put(client)
+            queue.append((func, args, time.time()))
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            pause = len(queue) >= self.backlog and client not in self._paused
+            if pause:
+                self._paused.add(client)
+        if pause:
+            logger.info('Pausing reads from %s: %d tasks waiting', client.name, len(queue))
+            client.server._pause_reading(client)
+
+    def _work(self):
+        while True:
+            client = self._ready.get()
+            if client is None:
+                break
+            with self._lock:
+                func, args, queued_at = self._pending[client].popleft()
+                self.queued -= 1
+
+            start = time.time()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Handler failure: %s: %r', client.name, func)
+            end = time.time()
+
+            with self._lock:
+                self.tasks += 1
+                self.total_wait += start - queued_at
+                self.total_time += end - start
+                self.max_time = max(self.max_time, end - start)
+                queue = self._pending[client]
+                resume = client in self._paused and len(queue) <= self.backlog // 2
+                if resume:
+                    self._paused.discard(client)
+                if queue:
+                    # Back of the line, so a busy connection doesn't starve the rest.
+                    self._ready.put(client)
+                else:
+                    del self._pending[client]
+                    self._paused.discard(client)
+                    if not self._pending:
+                        self._idle.notify_all()
+            if resume:
+                logger.info('Resuming reads from %s', client.name)
+                client.server._resume_reading(client)
+
+    def idle(self):
+        with self._lock:
+            return not self._pending
+
+    def shutdown(self):
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+        for thread in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'max-queued': self.max_queued,
+                'connections': len(self._pending),
+                'paused': len(self._paused),
+                'tasks': self.tasks,
+                'average-wait': self.total_wait / self.tasks if self.tasks else 0.0,
+                'average-time': self.total_time / self.tasks if self.tasks else 0.0,
+                'max-time': self.max_time,
+            }
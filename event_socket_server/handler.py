@@ -6,6 +6,8 @@ class Handler(object):
         self._socket = socket
         self.server = server
         self.name = socket.getpeername()
+        self.bytes_received = 0
+        self.bytes_sent = 0
 
     def fileno(self):
         return self._socket.fileno()
@@ -13,6 +15,14 @@ class Handler(object):
     def _recv_data(self, data):
         raise NotImplementedError
 
+    def _recv_buffer(self, size):
+        # Handlers that can receive in place return a writable buffer of at most size bytes,
+        # and are then notified through _recv_commit instead of _recv_data.
+        return None
+
+    def _recv_commit(self, size):
+        raise NotImplementedError
+
     def _send(self, data, callback=None):
         return self.server.send(self, data, callback)
 
@@ -22,6 +32,20 @@ class Handler(object):
     def on_close(self):
         pass
 
+    def handoff_state(self):
+        # What another process needs to carry on with this connection, as something JSON can encode,
+        # or None if it can't be handed off. See BaseServer.hand_off.
+        return {}
+
+    def restore_state(self, state):
+        # Called on the handler for a connection taken over from another process, with its handoff_state.
+        pass
+
+    def on_send_backlog(self, backlogged):
+        # Called when the server stops reading from this client because too much is waiting to be sent
+        # to it, and again once that has drained.
+        pass
+
     @property
     def socket(self):
         return self._socket
\ No newline at end of file
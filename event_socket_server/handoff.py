@@ -0,0 +1,75 @@
+import json
+import logging
+import socket
+
+from _multiprocessing import recvfd, sendfd
+
+from .helpers import SizedPacketHandler, size_pack
+
+__author__ = 'Quantum'
+logger = logging.getLogger('event_socket_server')
+
+HANDOFF_REQUEST = 'handoff'
+
+
+def recv_exactly(sock, size):
+    data = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise IOError('Connection closed during handoff')
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+
+def send_handoff(sock, state, fds):
+    """Sends state, then the descriptors fds one by one with SCM_RIGHTS, over the Unix domain socket sock."""
+    data = json.dumps(dict(state, fds=len(fds)))
+    sock.setblocking(1)
+    sock.sendall(size_pack.pack(len(data)) + data)
+    for fd in fds:
+        sendfd(sock.fileno(), fd)
+
+
+def recv_handoff(sock):
+    """Receives what send_handoff sent, returning the state and the new descriptors."""
+    length = size_pack.unpack(recv_exactly(sock, size_pack.size))[0]
+    state = json.loads(recv_exactly(sock, length))
+    return state, [recvfd(sock.fileno()) for i in xrange(state['fds'])]
+
+
+class HandoffHandler(SizedPacketHandler):
+    """Listens for a new process asking to take over, on a Unix domain socket only it can reach."""
+
+    def _packet(self, data):
+        if str(data) != HANDOFF_REQUEST:
+            logger.warning('Bad handoff request from %s', self.name)
+            self.close()
+            return
+        self.server.call_soon(self.server.hand_off, self)
+
+    def handoff_state(self):
+        return None
+
+
+def take_over(server, path, handlers):
+    """Asks the process listening for handoffs at path for its listeners and connections, and restores them
+    into server. Returns False if there is no such process."""
+    if not server.supports_handoff:
+        # Found out before asking, so the other process carries on.
+        raise NotImplementedError('%s cannot take over connections' % server.__class__.__name__)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        logger.info('Nothing to take over at %s: %s', path, e)
+        sock.close()
+        return False
+    try:
+        sock.sendall(size_pack.pack(len(HANDOFF_REQUEST)) + HANDOFF_REQUEST)
+        state, fds = recv_handoff(sock)
+    finally:
+        sock.close()
+    server.restore(state, fds, handlers)
+    return True
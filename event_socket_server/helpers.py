@@ -1,46 +1,268 @@
+import json
+import logging
 import struct
+import zlib
+
 from .handler import Handler
 
 __author__ = 'Quantum'
+logger = logging.getLogger('event_socket_server')
 size_pack = struct.Struct('!I')
 
+# The top two bits of a frame's length word say how its payload is encoded. Peers that only speak the
+# original framing always leave them clear, and are never sent anything but FRAME_LEGACY frames.
+FRAME_LEGACY = 0            # a complete zlib stream
+FRAME_STREAM = 1 << 30      # the next piece of the connection's zlib stream, ending in a sync flush
+FRAME_RAW = 2 << 30         # uncompressed
+FRAME_CONTROL = 3 << 30     # uncompressed JSON codec negotiation
+FRAME_TYPE_MASK = 3 << 30
+FRAME_LENGTH_MASK = ~FRAME_TYPE_MASK & 0xFFFFFFFF
+
+STREAM_CODEC = 'zlib-stream'
+
+
+def dictionary_id(dictionary):
+    return zlib.crc32(dictionary) & 0xFFFFFFFF if dictionary else None
+
+
+class StreamCodec(object):
+    """One direction pair of a negotiated zlib stream.
+
+    Python 2's zlib has no preset dictionary support, so both ends prime their streams by running
+    the dictionary through them and discarding the output. The decompressor's window only depends
+    on the decompressed bytes, so each side can prime with its own compressor's output.
+    """
+
+    def __init__(self, dictionary=None, level=6):
+        self._compressor = zlib.compressobj(level)
+        self._decompressor = zlib.decompressobj()
+        if dictionary:
+            self._decompressor.decompress(self.compress(dictionary))
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
 
 class SizedPacketHandler(Handler):
+    # Receive buffer capacity. The buffer grows as a larger frame arrives, and shrinks back once it is handled.
+    buffer_size = 65536
+    # A buffer grown past this many times buffer_size is given back once the large frame is handled.
+    shrink_factor = 4
+    # Longest frame a peer may send; a connection announcing a longer one is closed.
+    max_packet_length = 16 * 1024 * 1024
+    # Turns packets into frames and back (see serializers), or None to send and receive bytes as they are.
+    serializer = None
+
     def __init__(self, server, socket):
         super(SizedPacketHandler, self).__init__(server, socket)
-        self._buffer = ''
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._buffer_start = 0
+        self._buffer_end = 0
         self._packetlen = 0
+        # Type bits of the frame being delivered to _packet.
+        self._frame_type = FRAME_LEGACY
 
     def _packet(self, data):
+        # data is a read-only view into the receive buffer, only valid for the duration of the call.
         raise NotImplementedError()
 
     def _format_send(self, data):
-        return data
+        return data if self.serializer is None else self.serializer.dumps(data)
 
-    def _recv_data(self, data):
-        self._buffer += data
-        while len(self._buffer) >= self._packetlen if self._packetlen else len(self._buffer) >= size_pack.size:
+    def _parse(self, data):
+        return data if self.serializer is None else self.serializer.loads(data)
+
+    def _recv_buffer(self, size):
+        end = self._buffer_end
+        free = len(self._buffer) - end
+        if free < size:
+            # Reads go into whatever room is left, as long as it holds what the current frame still needs and
+            # isn't so small that it takes many reads to fill.
+            pending = end - self._buffer_start
+            missing = self._packetlen - pending if self._packetlen else size_pack.size
+            want = min(size, max(missing, size >> 2))
+            if free < want:
+                self._make_room(want, missing, size)
+                end = self._buffer_end
+        return self._view[end:end + size]
+
+    def _make_room(self, want, missing, size):
+        buf = self._buffer
+        pending = self._buffer_end - self._buffer_start
+        if self._buffer_start:
+            buf[:pending] = buf[self._buffer_start:self._buffer_end]
+            self._buffer_start, self._buffer_end = 0, pending
+        free = len(buf) - pending
+        if free < want:
+            # Doubling for a frame that doesn't fit, but never past what the frame needs: its announced length
+            # alone is no reason to allocate it.
+            self._view = None
+            buf.extend(bytearray(max(want, min(len(buf), missing)) - free))
+            self._view = memoryview(buf)
+
+    def _recv_commit(self, size):
+        self._buffer_end += size
+        if self._packetlen and self._buffer_end - self._buffer_start < self._packetlen:
+            # The middle of a frame.
+            return
+        buf = self._buffer
+        while True:
+            pending = self._buffer_end - self._buffer_start
             if self._packetlen:
-                data = self._buffer[:self._packetlen]
-                self._buffer = self._buffer[self._packetlen:]
+                if pending < self._packetlen:
+                    break
+                start, length = self._buffer_start, self._packetlen
+                self._buffer_start += length
                 self._packetlen = 0
-                self._packet(data)
+                self._packet(buffer(buf, start, length))
             else:
-                data = self._buffer[:size_pack.size]
-                self._buffer = self._buffer[size_pack.size:]
-                self._packetlen = size_pack.unpack(data)[0]
+                if pending < size_pack.size:
+                    break
+                header = size_pack.unpack_from(buf, self._buffer_start)[0]
+                self._buffer_start += size_pack.size
+                self._frame_type = header & FRAME_TYPE_MASK
+                self._packetlen = header & FRAME_LENGTH_MASK
+                if self._packetlen > self.max_packet_length:
+                    logger.warning('Closing %s: frame of %d bytes is too long', self.name, self._packetlen)
+                    self.close()
+                    return
+                if not self._packetlen:
+                    self._packet(buffer(''))
+        pending = self._buffer_end - self._buffer_start
+        if len(buf) > self.shrink_factor * self.buffer_size and pending <= self.buffer_size and \
+                self._packetlen <= self.buffer_size:
+            # Done with the large frame the buffer grew for.
+            self._buffer = bytearray(self.buffer_size)
+            self._buffer[:pending] = buf[self._buffer_start:self._buffer_end]
+            self._view = memoryview(self._buffer)
+            self._buffer_start, self._buffer_end = 0, pending
+        elif self._buffer_start == self._buffer_end:
+            self._buffer_start = self._buffer_end = 0
+
+    def _recv_data(self, data):
+        while data:
+            view = self._recv_buffer(len(data))
+            size = len(view)
+            view[:] = data[:size]
+            del view
+            self._recv_commit(size)
+            data = data[size:]
+
+    def handoff_state(self):
+        state = super(SizedPacketHandler, self).handoff_state()
+        if state is not None:
+            # Only ever the start of a frame: complete ones are handled as soon as they arrive.
+            state['buffered'] = str(self._buffer[self._buffer_start:self._buffer_end]).encode('base64')
+            state['packet-length'] = self._packetlen
+            state['frame-type'] = self._frame_type
+        return state
+
+    def restore_state(self, state):
+        super(SizedPacketHandler, self).restore_state(state)
+        self._packetlen = state['packet-length']
+        self._frame_type = state['frame-type']
+        buffered = state['buffered'].decode('base64')
+        if buffered:
+            self._recv_data(buffered)
+
+    def _send_frame(self, frame_type, data, callback=None):
+        if len(data) > FRAME_LENGTH_MASK:
+            # The length would run into the frame type bits and leave the peer reading garbage.
+            raise ValueError('frame of %d bytes is too long to send' % len(data))
+        self._send(size_pack.pack(frame_type | len(data)) + data, callback)
 
     def send(self, data, callback=None):
-        data = self._format_send(data)
-        self._send(size_pack.pack(len(data)) + data, callback)
+        self._send_frame(FRAME_LEGACY, self._format_send(data), callback)
 
 
 class ZlibPacketHandler(SizedPacketHandler):
-    def _format_send(self, data):
-        return data.encode('zlib')
+    # Preset dictionary for negotiated streams: the strings that packets are mostly made of.
+    zlib_dictionary = None
+    # Once a stream is negotiated, frames shorter than this are sent uncompressed.
+    raw_threshold = 64
+    zlib_level = 6
+    # Serializers a peer may switch the connection to, in order of preference, instead of serializer.
+    serializers = ()
+
+    def __init__(self, server, socket):
+        super(ZlibPacketHandler, self).__init__(server, socket)
+        self._codec = None
 
     def packet(self, data):
         raise NotImplementedError()
 
+    def _encode(self, data):
+        if self._codec is None:
+            return FRAME_LEGACY, zlib.compress(data, self.zlib_level)
+        if len(data) < self.raw_threshold:
+            return FRAME_RAW, data
+        return FRAME_STREAM, self._codec.compress(data)
+
+    def send(self, data, callback=None):
+        data = self._format_send(data)
+        # Stream frames have to go out in the order they were compressed.
+        with self.server._lock:
+            frame_type, data = self._encode(data)
+            self._send_frame(frame_type, data, callback)
+
     def _packet(self, data):
-        self.packet(data.decode('zlib'))
+        frame_type = self._frame_type
+        if frame_type == FRAME_LEGACY:
+            data = zlib.decompress(data)
+        elif frame_type == FRAME_STREAM:
+            if self._codec is None:
+                raise ValueError('zlib stream frame before negotiation')
+            data = self._codec.decompress(data)
+        elif frame_type == FRAME_RAW:
+            data = str(data)
+        else:
+            self._negotiate(json.loads(str(data)))
+            return
+        self.server._run_handler(self, self.packet, data)
+
+    def handoff_state(self):
+        if self._codec is not None:
+            # zlib streams can't be copied to another process.
+            return None
+        state = super(ZlibPacketHandler, self).handoff_state()
+        if state is not None:
+            state['serializer'] = self.serializer and self.serializer.name
+        return state
+
+    def restore_state(self, state):
+        super(ZlibPacketHandler, self).restore_state(state)
+        serializer = type(self).serializer
+        if state['serializer'] != (serializer and serializer.name):
+            serializer = next((candidate for candidate in self.serializers if candidate.name == state['serializer']),
+                              serializer)
+        self.serializer = serializer
+
+    def _negotiate(self, offer):
+        dictionary = None
+        if offer.get('codec') == STREAM_CODEC:
+            if offer.get('dictionary') is not None and offer['dictionary'] == dictionary_id(self.zlib_dictionary):
+                dictionary = self.zlib_dictionary
+            reply = {'codec': STREAM_CODEC, 'dictionary': dictionary_id(dictionary)}
+        else:
+            reply = {'codec': None}
+
+        serializer = None
+        if 'serializers' in offer:
+            # Ours in our order of preference, the first that the peer also offered. None means the default.
+            offered = set(offer['serializers'] or ())
+            serializer = next((candidate for candidate in self.serializers if candidate.name in offered), None)
+            reply['serializer'] = serializer and serializer.name
+            serializer = serializer or type(self).serializer
+
+        with self.server._lock:
+            self._send_frame(FRAME_CONTROL, json.dumps(reply, separators=(',', ':')))
+            if reply['codec'] == STREAM_CODEC:
+                self._codec = StreamCodec(dictionary, self.zlib_level)
+            if 'serializer' in reply:
+                # Frames the peer sent before seeing the reply are in the old encoding, so serializers offered
+                # this way have to keep reading JSON.
+                self.serializer = serializer
@@ -0,0 +1,173 @@
+import threading
+import time
+
+__author__ = 'Quantum'
+
+
+class Histogram(object):
+    """Approximate distribution of non-negative samples, kept in power-of-two buckets.
+
+    Bucket i counts samples below unit * 2 ** i, so percentiles are only accurate to a factor of two,
+    which is plenty to tell a 1ms loop iteration from a 100ms one. Adding a sample is a few integer
+    operations under an uncontended lock.
+    """
+    buckets = 32
+
+    def __init__(self, unit=1e-6):
+        self.unit = unit
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        index = min(int(max(value, 0) / self.unit).bit_length(), self.buckets - 1)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def copy(self):
+        other = Histogram(self.unit)
+        with self._lock:
+            other.counts = self.counts[:]
+            other.count = self.count
+            other.total = self.total
+            other.max = self.max
+        return other
+
+    @classmethod
+    def combine(cls, histograms, unit=1e-6):
+        """Returns a histogram of the samples in all of histograms, which must have the same unit."""
+        other = cls(unit)
+        for histogram in histograms:
+            histogram = histogram.copy()
+            other.counts = [ours + theirs for ours, theirs in zip(other.counts, histogram.counts)]
+            other.count += histogram.count
+            other.total += histogram.total
+            other.max = max(other.max, histogram.max)
+        return other
+
+    def since(self, earlier):
+        """Returns the samples added after earlier, a copy of this histogram."""
+        other = Histogram(self.unit)
+        other.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        other.count = self.count - earlier.count
+        other.total = self.total - earlier.total
+        top = max([i for i, count in enumerate(other.counts) if count] or [None])
+        if top is not None:
+            other.max = min(self.max, self.unit * (1 << top))
+        return other
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, self.unit * (1 << index))
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class ServerMetrics(object):
+    """Counters and histograms kept by a server's event loop and its handlers.
+
+    Times are in seconds and sizes in bytes. Only the event loop updates the plain counters; the
+    histograms may be added to from any thread.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.iterations = 0
+        self.events = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Time spent handling the events returned by one poll, excluding the wait for them.
+        self.loop = Histogram()
+        self.scheduler_lag = Histogram()
+        # Bytes waiting to be sent to a client, sampled whenever something is queued behind them.
+        self.send_queue = Histogram(unit=1)
+        # Connections accepted per readiness event on a listener.
+        self.accept_batch = Histogram(unit=1)
+        self.handlers = {}
+        self._handlers_lock = threading.Lock()
+
+    def iteration(self, start, events):
+        self.iterations += 1
+        if events:
+            # Timeouts would only drown out the iterations that did work.
+            self.events += events
+            self.loop.add(time.time() - start)
+
+    def handler_time(self, name, elapsed):
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            with self._handlers_lock:
+                histogram = self.handlers.setdefault(name, Histogram())
+        histogram.add(elapsed)
+
+    def copy(self):
+        other = ServerMetrics()
+        other.started = self.started
+        other.iterations = self.iterations
+        other.events = self.events
+        other.bytes_in = self.bytes_in
+        other.bytes_out = self.bytes_out
+        other.loop = self.loop.copy()
+        other.scheduler_lag = self.scheduler_lag.copy()
+        other.send_queue = self.send_queue.copy()
+        other.accept_batch = self.accept_batch.copy()
+        with self._handlers_lock:
+            other.handlers = dict((name, histogram.copy()) for name, histogram in self.handlers.iteritems())
+        return other
+
+    def snapshot(self):
+        return {
+            'uptime': time.time() - self.started,
+            'iterations': self.iterations,
+            'events': self.events,
+            'bytes-in': self.bytes_in,
+            'bytes-out': self.bytes_out,
+            'loop': self.loop.snapshot(),
+            'scheduler-lag': self.scheduler_lag.snapshot(),
+            'send-queue': self.send_queue.snapshot(),
+            'accept-batch': self.accept_batch.snapshot(),
+            'handlers': dict((name, histogram.snapshot()) for name, histogram in self.handlers.items()),
+        }
+
+    def summary(self, earlier, elapsed):
+        """One line describing what happened in the elapsed seconds since earlier, a copy of these metrics."""
+        loop = self.loop.since(earlier.loop)
+        lag = self.scheduler_lag.since(earlier.scheduler_lag)
+        queue = self.send_queue.since(earlier.send_queue)
+        slowest = None
+        for name, histogram in self.handlers.items():
+            if name in earlier.handlers:
+                histogram = histogram.since(earlier.handlers[name])
+            if histogram.count and (slowest is None or histogram.max > slowest[1].max):
+                slowest = name, histogram
+        line = ('%.0f events/s, loop p50 %.1fms p99 %.1fms max %.1fms, timer lag p99 %.1fms, '
+                'in %.1fKB/s, out %.1fKB/s, send queue p99 %dB') % (
+            (self.events - earlier.events) / elapsed, loop.percentile(0.5) * 1000,
+            loop.percentile(0.99) * 1000, loop.max * 1000, lag.percentile(0.99) * 1000,
+            (self.bytes_in - earlier.bytes_in) / elapsed / 1024, (self.bytes_out - earlier.bytes_out) / elapsed / 1024,
+            queue.percentile(0.99))
+        if slowest is not None:
+            line += ', slowest handler %s: %d calls, p99 %.1fms max %.1fms' % (
+                slowest[0], slowest[1].count, slowest[1].percentile(0.99) * 1000, slowest[1].max * 1000)
+        return line
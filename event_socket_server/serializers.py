@@ -0,0 +1,113 @@
+import json
+import struct
+
+__author__ = 'Quantum'
+
+
+class Serializer(object):
+    """Turns packets into the bytes of a frame and back."""
+    name = None
+
+    def dumps(self, packet):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class JSONSerializer(Serializer):
+    name = 'json'
+
+    def dumps(self, packet):
+        return json.dumps(packet, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(str(data))
+
+
+class PacketShape(object):
+    """The fields of one kind of dict packet, for PackedSerializer.
+
+    ints and floats are packed into a fixed struct; strings follow it, each with its length in the struct.
+    """
+
+    def __init__(self, id, name, ints=(), floats=(), strings=()):
+        self.id = id
+        self.name = name
+        self.ints = tuple(ints)
+        self.floats = tuple(floats)
+        self.strings = tuple(strings)
+        self.fields = self.ints + self.floats
+        self.size = 1 + len(self.fields) + len(self.strings)
+        self.struct = struct.Struct('!B%dq%dd%dI' % (len(self.ints), len(self.floats), len(self.strings)))
+
+    def matches(self, packet):
+        if len(packet) != self.size:
+            return False
+        try:
+            for key in self.ints:
+                if type(packet[key]) not in (int, long):
+                    return False
+            for key in self.floats:
+                if type(packet[key]) is not float:
+                    return False
+            for key in self.strings:
+                if not isinstance(packet[key], basestring):
+                    return False
+        except KeyError:
+            return False
+        return True
+
+    def pack(self, packet):
+        strings = [packet[key].encode('utf-8') if isinstance(packet[key], unicode) else packet[key]
+                   for key in self.strings]
+        values = [self.id] + [packet[key] for key in self.fields] + [len(string) for string in strings]
+        return self.struct.pack(*values) + ''.join(strings)
+
+    def unpack(self, data):
+        values = self.struct.unpack_from(data)
+        packet = dict(zip(self.fields, values[1:len(self.fields) + 1]))
+        packet['name'] = self.name
+        offset = self.struct.size
+        for key, length in zip(self.strings, values[len(self.fields) + 1:]):
+            packet[key] = data[offset:offset + length].decode('utf-8')
+            offset += length
+        return packet
+
+
+class PackedSerializer(Serializer):
+    """Packs the hot packet types into structs, falling back to JSON for everything else.
+
+    Packed frames start with a shape id below 0x7B, so JSON frames, which start with '{', can always be
+    told apart and are accepted too. Both ends need the same shapes, so name them with a version.
+    """
+
+    def __init__(self, name, shapes):
+        self.name = name
+        self._json = JSONSerializer()
+        self._by_id = {}
+        self._by_name = {}
+        for shape in shapes:
+            assert 0 < shape.id < ord('{')
+            self._by_id[shape.id] = shape
+            self._by_name.setdefault(shape.name, []).append(shape)
+
+    def dumps(self, packet):
+        for shape in self._by_name.get(packet.get('name'), ()):
+            if shape.matches(packet):
+                try:
+                    return shape.pack(packet)
+                except struct.error:
+                    # An int out of range for the struct.
+                    break
+        return self._json.dumps(packet)
+
+    def loads(self, data):
+        data = str(data)
+        shape = self._by_id.get(ord(data[0])) if data else None
+        if shape is None:
+            return self._json.loads(data)
+        try:
+            return shape.unpack(data)
+        except struct.error:
+            raise ValueError('Truncated %s packet' % shape.name)
@@ -28,6 +28,20 @@ def dezlibify(data, skip_head=True):
     return data.decode('zlib')
 
 
+def recv_exactly(sock, size):
+    result = ''
+    while len(result) < size:
+        data = sock.recv(min(size - len(result), 65536))
+        assert data, 'Connection closed'
+        result += data
+    return result
+
+
+def recv_packet(sock):
+    size = size_pack.unpack(recv_exactly(sock, size_pack.size))[0]
+    return dezlibify(recv_exactly(sock, size), False)
+
+
 def random(length):
     if RtlGenRandom is None:
         with open('/dev/urandom') as f:
@@ -69,17 +83,31 @@ def main():
     print 'Generated',
     s4.sendall(zlibify(data))
     print 'Sent',
-    result = ''
-    while len(result) < size_pack.size:
-        result += s4.recv(1024)
-    size = size_pack.unpack(result[:size_pack.size])[0]
-    result = result[size_pack.size:]
-    while len(result) < size:
-        result += s4.recv(1024)
+    result = recv_packet(s4)
     print 'Received',
-    assert dezlibify(result, False) == data
+    assert result == data
     print 'Success'
     s4.close()
+    print 'Split frame test:',
+    s6 = open_connection()
+    s6.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    packet = zlibify('Split across writes')
+    for piece in (packet[:2], packet[2:size_pack.size + 3], packet[size_pack.size + 3:]):
+        s6.sendall(piece)
+        time.sleep(0.1)
+    assert recv_packet(s6) == 'Split across writes'
+    print 'Success'
+    print 'Pipelined frames test:',
+    packets = [random(i * 100) for i in xrange(1, 21)]
+    stream = ''.join(map(zlibify, packets))
+    # Many frames in one write, the last of them cut short until the next write.
+    s6.sendall(stream[:-10])
+    time.sleep(0.1)
+    s6.sendall(stream[-10:])
+    for data in packets:
+        assert recv_packet(s6) == data
+    print 'Success'
+    s6.close()
     print 'Test malformed connection:',
     s5 = open_connection()
     s5.sendall(data[:100000])
@@ -34,8 +34,8 @@ def main():
     args = parser.parse_args()
 
     class TestServer(engines[args.engine]):
-        def _accept(self):
-            client = super(TestServer, self)._accept()
+        def _accept(self, listener):
+            client = super(TestServer, self)._accept(listener)
             print 'New connection:', client.socket.getpeername()
             return client
 
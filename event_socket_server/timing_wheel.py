@@ -0,0 +1,118 @@
+import math
+
+__author__ = 'Quantum'
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+
+
+class TimingWheel(object):
+    """Hierarchical timing wheel for scheduled jobs.
+
+    Jobs need a ``time`` attribute (absolute, in seconds) and room for ``expires`` and ``bucket``.
+    Adding and removing a job is O(1); each job is moved down at most ``levels - 1`` times before
+    it expires. Jobs further away than the wheels reach are parked in the last slot of the top
+    wheel and placed again when it comes around.
+    """
+
+    def __init__(self, now, resolution=0.01, levels=4):
+        self.resolution = resolution
+        self.levels = levels
+        self._wheels = [[set() for i in xrange(WHEEL_SIZE)] for level in xrange(levels)]
+        self._span = 1 << (WHEEL_BITS * levels)
+        # The next tick to be processed.
+        self._tick = self._to_tick(now)
+        self._count = 0
+        # Lateness, in seconds, of the most late job in the last advance, and the worst seen so far.
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def _to_tick(self, when):
+        return int(when / self.resolution)
+
+    def _place(self, job):
+        delta = job.expires - self._tick
+        if delta < 0:
+            expires, delta = self._tick, 0
+        elif delta >= self._span:
+            expires, delta = self._tick + self._span - 1, self._span - 1
+        else:
+            expires = job.expires
+        level = 0
+        while delta >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        bucket = self._wheels[level][(expires >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        bucket.add(job)
+        job.bucket = bucket
+
+    def add(self, job):
+        # Round up so that no job runs before its time.
+        job.expires = int(math.ceil(job.time / self.resolution))
+        self._place(job)
+        self._count += 1
+
+    def remove(self, job):
+        if job.bucket is None:
+            return False
+        job.bucket.discard(job)
+        job.bucket = None
+        self._count -= 1
+        return True
+
+    def _cascade(self, level):
+        index = (self._tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+        wheel = self._wheels[level]
+        bucket, wheel[index] = wheel[index], set()
+        for job in bucket:
+            self._place(job)
+        return index
+
+    def advance(self, now):
+        """Returns the jobs that are due at now, in order of expiry."""
+        target = self._to_tick(now)
+        if not self._count:
+            self._tick = max(self._tick, target + 1)
+            self.lag = 0.0
+            return []
+
+        due = []
+        wheel = self._wheels[0]
+        while self._tick <= target and self._count:
+            index = self._tick & WHEEL_MASK
+            if not index:
+                level = 1
+                while level < self.levels and not self._cascade(level):
+                    level += 1
+            bucket = wheel[index]
+            if bucket:
+                wheel[index] = set()
+                jobs = sorted(bucket, key=lambda job: job.time)
+                for job in jobs:
+                    job.bucket = None
+                self._count -= len(jobs)
+                due.extend(jobs)
+            self._tick += 1
+        if not self._count:
+            self._tick = max(self._tick, target + 1)
+
+        self.lag = max(now - job.time for job in due) if due else 0.0
+        self.max_lag = max(self.max_lag, self.lag)
+        return due
+
+    def timeout(self, now, limit=1):
+        """Returns how long the event loop may sleep before the next job could be due, up to limit."""
+        if not self._count:
+            return limit
+        wheel = self._wheels[0]
+        # Only the bottom wheel is scanned, up to the next tick that cascades the higher wheels into it.
+        boundary = -self._tick & WHEEL_MASK
+        for offset in xrange(boundary):
+            if wheel[(self._tick + offset) & WHEEL_MASK]:
+                break
+        else:
+            offset = boundary
+        return min(limit, max(0, (self._tick + offset) * self.resolution - now))
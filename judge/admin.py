@@ -21,6 +21,7 @@ from reversion.admin import VersionAdmin
 from reversion_compare.admin import CompareVersionAdmin
 
 from judge.dblock import LockModel
+from judge.judgeapi import judge_submissions
 from judge.models import Language, Profile, Problem, ProblemGroup, ProblemType, Submission, Comment, \
     MiscConfig, Judge, NavigationBar, Contest, ContestParticipation, ContestProblem, Organization, BlogPost, \
     ContestProfile, SubmissionTestCase, Solution, Rating, ContestSubmission, License, LanguageLimit, OrganizationRequest, \
@@ -445,10 +446,7 @@ class SubmissionAdmin(admin.ModelAdmin):
             return
         if not request.user.has_perm('judge.edit_all_problem'):
             queryset = queryset.filter(problem__authors__id=request.user.profile.id)
-        judged = len(queryset)
-        for model in queryset:
-            model.is_being_rejudged = True
-            model.judge()
+        judged = judge_submissions(queryset)
         self.message_user(request, ungettext('%d submission were successfully scheduled for rejudging.',
                                              '%d submissions were successfully scheduled for rejudging.',
                                              judged) % judged)
@@ -4,4 +4,3 @@ from .judgeserver import JudgeServer
 
 from .djangohandler import DjangoHandler
 from .judgecallback import DjangoJudgeHandler
-from .djangoserver import DjangoServer
\ No newline at end of file
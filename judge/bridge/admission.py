@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('judge.bridge')
+
+
+class AdmissionController(object):
+    """Lets at most limit clients at a time through an expensive step, queueing the rest in arrival order.
+
+    A client waiting its turn is not read from, so nothing it sends after the step overtakes it. Queued
+    steps are started where the client's handlers run: on the server's executor, or on the event loop
+    between its other work.
+    """
+
+    def __init__(self, server, limit):
+        self.server = server
+        self.limit = limit
+        self.active = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.max_waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, client, func, *args):
+        """Runs func(*args) for client now if there is room, and otherwise once there is."""
+        self.server._pause_reading(client)
+        with self._lock:
+            if self.active >= self.limit:
+                self.waiting.append((client, func, args, time.time()))
+                self.max_waiting = max(self.max_waiting, len(self.waiting))
+                logger.info('Admission queued: %s, %d waiting', client.name, len(self.waiting))
+                return
+            self.active += 1
+        self._run(client, func, args, time.time())
+
+    def _run(self, client, func, args, queued_at):
+        start = time.time()
+        with self._lock:
+            self.admitted += 1
+            self.total_wait += start - queued_at
+            self.max_wait = max(self.max_wait, start - queued_at)
+        try:
+            if client in self.server._clients:
+                self.server._resume_reading(client)
+                func(*args)
+        finally:
+            self._release()
+
+    def _release(self):
+        # The slot is handed on from the event loop's next tick: without an executor, steps run on the loop, and
+        # this keeps a queue of them from running back to back without the loop getting to anything else.
+        self.server.schedule(0, self._next)
+
+    def _next(self):
+        with self._lock:
+            if not self.waiting:
+                self.active -= 1
+                return
+            client, func, args, queued_at = self.waiting.popleft()
+        self.server._run_handler(client, self._run, client, func, args, queued_at)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'waiting': len(self.waiting),
+                'max-waiting': self.max_waiting,
+                'admitted': self.admitted,
+                'mean-wait': self.total_wait / self.admitted if self.admitted else 0.0,
+                'max-wait': self.max_wait,
+            }
@@ -0,0 +1,100 @@
+import time
+from collections import deque
+
+
+class JudgeRecord(object):
+    """What the bridge has seen a judge do: the problems it judged last, and how long grading takes on it."""
+
+    def __init__(self, recent):
+        self.problems = deque(maxlen=recent)
+        self.grading_time = None
+        self.current = {}
+
+    def begin(self, id, problem, affinity):
+        self.current[id] = problem, affinity, time.time()
+
+    def end(self, id, smoothing):
+        # Returns (problem, affinity, grading time) of the submission that ended, if it was sent from here.
+        if id not in self.current:
+            return None
+        problem, affinity, start = self.current.pop(id)
+        elapsed = time.time() - start
+        if self.grading_time is None:
+            self.grading_time = elapsed
+        else:
+            self.grading_time += smoothing * (elapsed - self.grading_time)
+        if problem in self.problems:
+            self.problems.remove(problem)
+        self.problems.append(problem)
+        return problem, affinity, elapsed
+
+
+class DispatchScorer(object):
+    """Picks which free judge gets a submission: the one with the lowest score."""
+
+    def score(self, judge, record, problem, language):
+        raise NotImplementedError()
+
+
+class LoadScorer(DispatchScorer):
+    def score(self, judge, record, problem, language):
+        return judge.load
+
+
+class AffinityScorer(DispatchScorer):
+    """Prefers judges that judged the problem recently and so likely have its test data cached, then lightly
+    loaded, nearby and fast ones, and ones with more of their slots free. Load is the judge's reported load
+    average per core, latency and grading time are in seconds; the weights bring them to the same scale."""
+    latency_weight = 10
+    grading_weight = 0.1
+    occupancy_weight = 1
+    affinity_bonus = 0.5
+
+    def score(self, judge, record, problem, language):
+        score = judge.load + self.occupancy_weight * (1 - judge.free_slots / float(judge.slots))
+        if judge.latency is not None:
+            score += self.latency_weight * judge.latency
+        if record.grading_time is not None:
+            score += self.grading_weight * record.grading_time
+        if problem in record.problems:
+            score -= self.affinity_bonus
+        return score
+
+
+class DispatchStats(object):
+    """Grading time of submissions sent to a judge that had judged the problem recently, against the rest."""
+
+    def __init__(self):
+        self.decisions = 0
+        self.choices = 0
+        self.totals = {True: [0, 0.0], False: [0, 0.0]}
+        self.problems = {}
+
+    def decided(self, candidates):
+        self.decisions += 1
+        self.choices += candidates
+
+    def graded(self, problem, affinity, elapsed):
+        total = self.totals[affinity]
+        total[0] += 1
+        total[1] += elapsed
+        problem = self.problems.setdefault(problem, {True: [0, 0.0], False: [0, 0.0]})[affinity]
+        problem[0] += 1
+        problem[1] += elapsed
+
+    @staticmethod
+    def _summary(totals):
+        return {
+            'affinity': totals[True][0],
+            'affinity-mean-time': totals[True][1] / totals[True][0] if totals[True][0] else None,
+            'other': totals[False][0],
+            'other-mean-time': totals[False][1] / totals[False][0] if totals[False][0] else None,
+        }
+
+    def snapshot(self, problems=20):
+        busiest = sorted(self.problems.iteritems(), key=lambda item: -(item[1][True][0] + item[1][False][0]))
+        stats = self._summary(self.totals)
+        stats['decisions'] = self.decisions
+        stats['mean-candidates'] = self.choices / float(self.decisions) if self.decisions else None
+        stats['problems'] = dict((problem, self._summary(totals)) for problem, totals in busiest[:problems])
+        return stats
@@ -1,20 +1,27 @@
 import logging
-import json
 import struct
+import time
 
-from event_socket_server import ZlibPacketHandler
+from event_socket_server import ZlibPacketHandler, JSONSerializer
+from judge import event_poster as event
+from judge.models import Submission
 
 logger = logging.getLogger('judge.bridge')
 size_pack = struct.Struct('!I')
 
 
 class DjangoHandler(ZlibPacketHandler):
+    serializer = JSONSerializer()
+
     def __init__(self, server, socket):
         super(DjangoHandler, self).__init__(server, socket)
 
         self.handlers = {
             'submission-request': self.on_submission,
+            'submission-batch-request': self.on_batch_submission,
             'terminate-submission': self.on_termination,
+            'stats': self.on_stats,
+            'queue-stats': self.on_queue_stats,
         }
         self._to_kill = True
         #self.server.schedule(5, self._kill_if_no_request)
@@ -24,17 +31,19 @@ class DjangoHandler(ZlibPacketHandler):
             logger.info('Killed inactive connection: %s', self._socket.getpeername())
             self.close()
 
-    def _format_send(self, data):
-        return super(DjangoHandler, self)._format_send(json.dumps(data, separators=(',', ':')))
-
     def packet(self, packet):
         self._to_kill = False
-        packet = json.loads(packet)
+        packet = self._parse(packet)
+        name = packet.get('name', None)
+        if name not in self.handlers:
+            name = 'malformed'
+        start = time.time()
         try:
-            result = self.handlers.get(packet.get('name', None), self.on_malformed)(packet)
+            result = self.handlers.get(name, self.on_malformed)(packet)
         except:
             logger.exception('Error in packet handling (Django-facing)')
             result = {"name": "bad-request"}
+        self.server.metrics.handler_time(name, time.time() - start)
         self.send(result, self._schedule_close)
 
     def _schedule_close(self):
@@ -45,14 +54,44 @@ class DjangoHandler(ZlibPacketHandler):
         problem = data['problem-id']
         language = data['language']
         source = data['source']
-        self.server.judges.judge(id, problem, language, source)
+        self.server.judges.judge(id, problem, language, source, data.get('priority'), data.get('user-id'))
         return {'name': 'submission-received', 'submission-id': id}
 
+    def on_batch_submission(self, data):
+        # Sources are left for the judge to load when it gets each submission, so a large rejudge doesn't keep
+        # them all in memory.
+        priority = data.get('priority')
+        submissions = Submission.objects.filter(id__in=data['submission-ids']) \
+            .values_list('id', 'problem__code', 'language__key', 'user_id')
+        received, skipped = [], []
+        for id, problem, language, user in submissions:
+            if self.server.judges.judge(id, problem, language, None, priority, user):
+                received.append(id)
+            else:
+                skipped.append(id)
+        return {'name': 'submission-batch-received', 'submission-ids': received, 'skipped-ids': skipped}
+
     def on_termination(self, data):
+        id = data['submission-id']
         try:
-            self.server.judges.abort(data['submission-id'])
+            queued = self.server.judges.abort(id)
         except KeyError:
             return {"name": "bad-request"}
+        if queued:
+            # It never reached a judge, so no judge will report it terminated.
+            Submission.objects.filter(id=id).update(status='AB', result='AB')
+            event.post('sub_%d' % id, {'type': 'aborted-submission'})
+
+    def on_stats(self, data):
+        return {'name': 'stats', 'server': self.server.stats()}
+
+    def on_queue_stats(self, data):
+        judges = self.server.judges
+        return {'name': 'queue-stats', 'stats': {
+            'priorities': judges.composition(),
+            'languages': judges.capacity(),
+            'timings': judges.timings_snapshot(),
+        }}
 
     def on_malformed(self, packet):
         logger.error('Malformed packet: %s', packet)
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('judge.bridge')
+
+QUEUED = 'q'
+DISPATCHED = 'd'
+FINISHED = 'f'
+
+
+def replay(path):
+    """Reads the journal at path, returning {id: [problem, language, priority, user, deadline, judge]} for every
+    submission queued and not finished, judge being the name of the judge it was sent to, if any."""
+    live = {}
+    try:
+        journal = open(path, 'rb')
+    except IOError:
+        return live
+    with journal:
+        for line in journal:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The last line, half written when the bridge died.
+                logger.warning('Ignoring a damaged line in the queue journal: %r', line)
+                continue
+            _apply(live, event)
+    return live
+
+
+def _apply(live, event):
+    kind, id = event[0], event[1]
+    if kind == QUEUED:
+        live[id] = list(event[2:]) + [None]
+    elif kind == DISPATCHED:
+        if id in live:
+            live[id][-1] = event[2]
+    elif kind == FINISHED:
+        live.pop(id, None)
+
+
+class QueueJournal(object):
+    """An append-only log of submissions being queued, sent to judges and finished, for the bridge to pick
+    them up again after it dies.
+
+    Events are handed to a writer thread, which writes whatever has built up every flush_interval seconds and
+    fsyncs once for all of it. Once the log holds compact_ratio times more events than there are live
+    submissions, the writer replaces it with just the live ones.
+    """
+    flush_interval = 0.05
+    compact_min = 10000
+    compact_ratio = 4
+
+    def __init__(self, path, live=None):
+        self.path = path
+        self.live = {} if live is None else live
+        self.written = 0
+        self.syncs = 0
+        self.compactions = 0
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._compact()
+        self._thread = threading.Thread(target=self._run, name='queue-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def queued(self, id, problem, language, priority, user, deadline):
+        self._record([QUEUED, id, problem, language, priority, user, deadline])
+
+    def dispatched(self, id, judge):
+        self._record([DISPATCHED, id, judge])
+
+    def finished(self, id):
+        self._record([FINISHED, id])
+
+    def _record(self, event):
+        with self._cond:
+            self._pending.append(event)
+            if len(self._pending) == 1:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+            # Let events gather so one fsync covers them.
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Writes out and syncs what has been recorded so far, without waiting for the writer."""
+        with self._write_lock:
+            with self._cond:
+                events, self._pending = self._pending, []
+            if not events:
+                return
+            try:
+                self._write(events)
+            except (IOError, OSError):
+                logger.exception('Failed to write the queue journal')
+
+    def _write(self, events):
+        self._file.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.syncs += 1
+        for event in events:
+            _apply(self.live, event)
+        self.written += len(events)
+        if self.written > self.compact_min and self.written > self.compact_ratio * len(self.live):
+            self._compact()
+
+    def _compact(self):
+        temp = self.path + '.new'
+        with open(temp, 'wb') as journal:
+            for id, (problem, language, priority, user, deadline, judge) in self.live.iteritems():
+                journal.write(json.dumps([QUEUED, id, problem, language, priority, user, deadline],
+                                         separators=(',', ':')) + '\n')
+                if judge is not None:
+                    journal.write(json.dumps([DISPATCHED, id, judge], separators=(',', ':')) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.rename(temp, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        self.written = len(self.live)
+        self.compactions += 1
+
+    def close(self):
+        """Writes out what is left and closes the journal."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
+
+    def stats(self):
+        return {
+            'live': len(self.live),
+            'written': self.written,
+            'syncs': self.syncs,
+            'compactions': self.compactions,
+            'pending': len(self._pending),
+        }
@@ -31,12 +31,11 @@ class DjangoJudgeHandler(JudgeHandler):
         # each value is (updates, last reset)
         self.update_counter = {}
 
-    def on_close(self):
-        super(DjangoJudgeHandler, self).on_close()
-        if self._working:
-            submission = Submission.objects.get(id=self._working)
-            submission.status = 'IE'
-            submission.save()
+    def _lost_submissions(self, requeued, abandoned):
+        if requeued:
+            Submission.objects.filter(id__in=requeued).update(status='QU')
+        if abandoned:
+            Submission.objects.filter(id__in=abandoned).update(status='IE')
 
     def problem_data(self, problem, language):
         _ensure_connection()  # We are called from the django-facing daemon thread. Guess what happens.
@@ -50,6 +49,10 @@ class DjangoJudgeHandler(JudgeHandler):
             time, memory = limit.time_limit, limit.memory_limit
         return time, memory, problem.short_circuit
 
+    def submission_source(self, id):
+        _ensure_connection()
+        return Submission.objects.filter(id=id).values_list('source', flat=True).get()
+
     def _authenticate(self, id, key):
         try:
             judge = Judge.objects.get(name=id)
@@ -306,7 +309,8 @@ class DjangoJudgeHandler(JudgeHandler):
         test_case.memory = packet['memory']
         test_case.points = packet['points']
         test_case.total = packet['total-points']
-        test_case.batch = self.batch_id if self.in_batch else None
+        in_flight = self.in_flight(packet)
+        test_case.batch = in_flight.batch_id if in_flight is not None and in_flight.in_batch else None
         test_case.feedback = packet.get('feedback', None) or ''
         test_case.output = packet['output']
         submission.current_testcase = packet['position'] + 1
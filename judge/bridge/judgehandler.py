@@ -1,16 +1,72 @@
 from __future__ import division
 
 import logging
-import json
 import time
 
 from collections import deque
-from event_socket_server import ZlibPacketHandler
+from event_socket_server import ZlibPacketHandler, JSONSerializer, PackedSerializer, PacketShape
 
 logger = logging.getLogger('judge.bridge')
 
+# Preset dictionary for judges that negotiate a zlib stream: the JSON fragments judge packets are made of,
+# with the most frequent ones last, where zlib finds them cheapest.
+ZLIB_DICTIONARY = ''.join([
+    '{"name":"handshake","problems":[],"executors":{},"id":"","key":""}',
+    '{"name":"handshake-success"}',
+    '{"name":"supported-problems","problems":[]}',
+    '{"name":"submission-request","submission-id":,"problem-id":"","language":"","source":"",'
+    '"time-limit":,"memory-limit":,"short-circuit":false}',
+    '{"name":"terminate-submission"}',
+    '{"name":"submission-terminated","submission-id":}',
+    '{"name":"internal-error","submission-id":,"message":""}',
+    '{"name":"compile-error","submission-id":,"log":""}',
+    '{"name":"compile-message","submission-id":,"log":""}',
+    '{"name":"submission-acknowledged","submission-id":}',
+    '{"name":"grading-begin","submission-id":}',
+    '{"name":"grading-end","submission-id":}',
+    '{"name":"batch-begin","submission-id":}',
+    '{"name":"batch-end","submission-id":}',
+    '{"name":"ping","when":}',
+    '{"name":"ping-response","when":,"time":,"load":}',
+    '{"name":"test-case-status","submission-id":,"position":,"status":0,"time":0.0,"memory":,'
+    '"points":0.0,"total-points":0.0,"output":"","feedback":""}',
+])
+
+# Struct layouts for the packets sent most, for judges that negotiate the packed serializer. The ids are
+# part of the protocol: add shapes under new ids, and bump the serializer name to change existing ones.
+PACKET_SHAPES = [
+    PacketShape(1, 'test-case-status', ints=('submission-id', 'position', 'status', 'memory'),
+                floats=('time', 'points', 'total-points'), strings=('output', 'feedback')),
+    PacketShape(2, 'test-case-status', ints=('submission-id', 'position', 'status', 'memory'),
+                floats=('time', 'points', 'total-points'), strings=('output',)),
+    PacketShape(3, 'ping', floats=('when',)),
+    PacketShape(4, 'ping-response', floats=('when', 'time', 'load')),
+    PacketShape(5, 'submission-acknowledged', ints=('submission-id',)),
+    PacketShape(6, 'grading-begin', ints=('submission-id',)),
+    PacketShape(7, 'grading-end', ints=('submission-id',)),
+    PacketShape(8, 'batch-begin', ints=('submission-id',)),
+    PacketShape(9, 'batch-end', ints=('submission-id',)),
+]
+PACKED_SERIALIZER = PackedSerializer('packed-1', PACKET_SHAPES)
+
+
+class InFlight(object):
+    """A submission sent to a judge that it has not finished yet."""
+
+    def __init__(self, id):
+        self.id = id
+        self.no_response_job = None
+        self.batch_id = None
+        self.in_batch = False
+
 
 class JudgeHandler(ZlibPacketHandler):
+    zlib_dictionary = ZLIB_DICTIONARY
+    serializer = JSONSerializer()
+    serializers = (PACKED_SERIALIZER,)
+    # Most submissions a judge may ask to be sent at once in its handshake.
+    max_slots = 64
+
     def __init__(self, server, socket):
         super(JudgeHandler, self).__init__(server, socket)
 
@@ -30,8 +86,9 @@ class JudgeHandler(ZlibPacketHandler):
             'handshake': self.on_handshake,
         }
         self._to_kill = True
-        self._working = False
-        self._no_response_job = None
+        # Submissions in flight, by id, at most slots of them.
+        self._working = {}
+        self.slots = 1
         self._problems = []
         self.executors = []
         self.problems = {}
@@ -39,11 +96,11 @@ class JudgeHandler(ZlibPacketHandler):
         self.time_delta = None
         self.load = 1e100
         self.name = None
-        self.batch_id = None
-        self.in_batch = False
         self.client_address = socket.getpeername()
         self._ping_average = deque(maxlen=6)  # 1 minute average, just like load
         self._time_delta = deque(maxlen=6)
+        # Packets that arrived while the handshake before them waited its turn.
+        self._deferred = None
 
         self.server.schedule(5, self._kill_if_no_auth)
         logger.info('Judge connected from: %s', self.client_address)
@@ -55,9 +112,19 @@ class JudgeHandler(ZlibPacketHandler):
 
     def on_close(self):
         self._to_kill = False
-        if self._no_response_job:
-            self.server.unschedule(self._no_response_job)
-        self.server.judges.remove(self)
+        # Submissions are handed to this judge under the list's lock, from other threads too.
+        with self.server.judges.lock:
+            for submission in self._working.itervalues():
+                if submission.no_response_job:
+                    self.server.unschedule(submission.no_response_job)
+            requeued, abandoned = self.server.judges.remove(self)
+            # Anything still to be handled from this judge is about submissions that are no longer its own.
+            self._working = {}
+        if requeued or abandoned:
+            self._lost_submissions(requeued, abandoned)
+        if requeued:
+            # Only now, or the site could mark them queued after another judge has begun grading them.
+            self.server.judges.dispatch_queued()
         if self.name is not None:
             self._disconnected()
         logger.info('Judge disconnected from: %s', self.client_address)
@@ -65,6 +132,9 @@ class JudgeHandler(ZlibPacketHandler):
     def _authenticate(self, id, key):
         return False
 
+    def _lost_submissions(self, requeued, abandoned):
+        pass
+
     def _connected(self):
         pass
 
@@ -74,30 +144,86 @@ class JudgeHandler(ZlibPacketHandler):
     def _update_ping(self):
         pass
 
-    def _format_send(self, data):
-        return super(JudgeHandler, self)._format_send(json.dumps(data, separators=(',', ':')))
-
     def on_handshake(self, packet):
         if 'id' not in packet or 'key' not in packet:
             logger.warning('Malformed handshake: %s', self.client_address)
             self.close()
             return
 
+        # Waiting for its turn doesn't count against the time a judge has to authenticate.
+        self._to_kill = False
+        self._deferred = []
+        self.server.handshakes.submit(self, self._handshake, packet)
+
+    def _handshake(self, packet):
+        deferred, self._deferred = self._deferred, None
         if not self._authenticate(packet['id'], packet['key']):
             logger.warning('Authentication failure: %s', self.client_address)
             self.close()
             return
 
-        self._to_kill = False
         self._problems = packet['problems']
         self.problems = dict(self._problems)
         self.executors = packet['executors']
         self.name = packet['id']
+        try:
+            self.slots = min(max(int(packet.get('slots', 1)), 1), self.max_slots)
+        except (TypeError, ValueError):
+            self.slots = 1
 
-        self.send({'name': 'handshake-success'})
+        self.send({'name': 'handshake-success', 'slots': self.slots})
         logger.info('Judge authenticated: %s (%s)', self.client_address, packet['id'])
         self.server.judges.register(self)
-        self._connected()
+        try:
+            self._connected()
+        finally:
+            for data in deferred:
+                self._dispatch(data)
+
+    def handoff_state(self):
+        if self._deferred is not None:
+            # Still waiting for its handshake to be processed; it will have to connect again.
+            return None
+        state = super(JudgeHandler, self).handoff_state()
+        if state is not None:
+            state['judge'] = {
+                'name': self.name,
+                'problems': self._problems,
+                'executors': self.executors,
+                'slots': self.slots,
+                'working': [[submission.id, submission.no_response_job is None, submission.batch_id,
+                             submission.in_batch] for submission in self._working.itervalues()],
+                'load': self.load,
+                'ping': list(self._ping_average),
+                'time-delta': list(self._time_delta),
+            }
+        return state
+
+    def restore_state(self, state):
+        super(JudgeHandler, self).restore_state(state)
+        judge = state['judge']
+        if judge['name'] is None:
+            return
+        self._to_kill = False
+        self.name = judge['name']
+        self._problems = judge['problems']
+        self.problems = dict(self._problems)
+        self.executors = judge['executors']
+        self.slots = judge['slots']
+        for id, acknowledged, batch_id, in_batch in judge['working']:
+            submission = self._working[id] = InFlight(id)
+            submission.batch_id = batch_id
+            submission.in_batch = in_batch
+            if not acknowledged:
+                submission.no_response_job = self.server.schedule(20, self._kill_if_no_response, id)
+        self.load = judge['load']
+        self._ping_average.extend(judge['ping'])
+        self._time_delta.extend(judge['time-delta'])
+        if self._ping_average:
+            self.latency = sum(self._ping_average) / len(self._ping_average)
+        if self._time_delta:
+            self.time_delta = sum(self._time_delta) / len(self._time_delta)
+        self.server.judges.restore(self)
 
     def can_judge(self, problem, executor):
         return problem in self.problems and executor in self.executors
@@ -106,13 +232,22 @@ class JudgeHandler(ZlibPacketHandler):
     def working(self):
         return bool(self._working)
 
+    @property
+    def free_slots(self):
+        return self.slots - len(self._working)
+
     def problem_data(self, problem, language):
         return 2, 16384, False
 
+    def submission_source(self, id):
+        return ''
+
     def submit(self, id, problem, language, source):
+        if source is None:
+            source = self.submission_source(id)
         time, memory, short = self.problem_data(problem, language)
-        self._working = id
-        self._no_response_job = self.server.schedule(20, self._kill_if_no_response)
+        submission = self._working[id] = InFlight(id)
+        submission.no_response_job = self.server.schedule(20, self._kill_if_no_response, id)
         self.send({
             'name': 'submission-request',
             'submission-id': id,
@@ -124,29 +259,36 @@ class JudgeHandler(ZlibPacketHandler):
             'short-circuit': short,
         })
 
-    def _kill_if_no_response(self):
-        logger.error('Judge seems dead: %s: %s', self.name, self._working)
+    def _kill_if_no_response(self, id):
+        logger.error('Judge seems dead: %s: %s', self.name, id)
         self.close()
 
     def on_submission_processing(self, packet):
         pass
 
     def on_submission_acknowledged(self, packet):
-        if not packet.get('submission-id', None) == self._working:
-            logger.error('Wrong acknowledgement: %s: %s, expected: %s', self.name, packet.get('submission-id', None),
-                         self._working)
+        submission = self._working.get(packet.get('submission-id', None))
+        if submission is None:
+            logger.error('Wrong acknowledgement: %s: %s, expected one of: %s', self.name,
+                         packet.get('submission-id', None), sorted(self._working))
             self.close()
-        logger.info('Submission acknowledged: %d', self._working)
-        if self._no_response_job:
-            self.server.unschedule(self._no_response_job)
-            self._no_response_job = None
+            return
+        logger.info('Submission acknowledged: %d', submission.id)
+        if submission.no_response_job:
+            self.server.unschedule(submission.no_response_job)
+            submission.no_response_job = None
+        self.server.judges.on_acknowledged(self, submission.id)
         self.on_submission_processing(packet)
 
-    def abort(self):
-        self.send({'name': 'terminate-submission'})
+    def abort(self, id):
+        self.send({'name': 'terminate-submission', 'submission-id': id})
+
+    def get_current_submissions(self):
+        return list(self._working)
 
-    def get_current_submission(self):
-        return self._working or None
+    def in_flight(self, packet):
+        # The submission a packet is about, or None if the judge isn't grading it.
+        return self._working.get(packet.get('submission-id'))
 
     def ping(self):
         self.send({'name': 'ping', 'when': time.time()})
@@ -154,19 +296,36 @@ class JudgeHandler(ZlibPacketHandler):
     def packet(self, data):
         try:
             try:
-                data = json.loads(data)
+                data = self._parse(data)
                 if 'name' not in data:
                     raise ValueError
             except ValueError:
                 self.on_malformed(data)
             else:
-                handler = self.handlers.get(data['name'], self.on_malformed)
-                handler(data)
+                if self._deferred is not None:
+                    self._deferred.append(data)
+                else:
+                    self._dispatch(data)
         except:
             logger.exception('Error in packet handling (Judge-side)')
             # You can't crash here because you aren't so sure about the judges
             # not being malicious or simply malforms. THIS IS A SERVER!
 
+    def _dispatch(self, data):
+        name = data['name'] if data['name'] in self.handlers else 'malformed'
+        if 'submission-id' in data and data['submission-id'] not in self._working and \
+                name != 'submission-acknowledged':
+            # Late or repeated, or from a judge the submission was taken off of.
+            logger.warning('%s: Ignoring %s for %s, which it is not grading', self.name, name, data['submission-id'])
+            return
+        start = time.time()
+        try:
+            self.handlers.get(name, self.on_malformed)(data)
+        except:
+            logger.exception('Error in packet handling (Judge-side)')
+        finally:
+            self.server.metrics.handler_time(name, time.time() - start)
+
     def _submission_is_batch(self, id):
         pass
 
@@ -174,17 +333,18 @@ class JudgeHandler(ZlibPacketHandler):
         logger.info('%s: Updated problem list', self.name)
         self._problems = packet['problems']
         self.problems = dict(self._problems)
-        if not self.working:
+        if self.free_slots > 0:
             self.server.judges.update_problems(self)
 
     def on_grading_begin(self, packet):
         logger.info('%s: Grading has begun on: %s', self.name, packet['submission-id'])
-        self.batch_id = None
+        submission = self.in_flight(packet)
+        if submission is not None:
+            submission.batch_id = None
 
     def on_grading_end(self, packet):
         logger.info('%s: Grading has ended on: %s', self.name, packet['submission-id'])
         self._free_self(packet)
-        self.batch_id = None
 
     def on_compile_error(self, packet):
         logger.info('%s: Submission failed to compile: %s', self.name, packet['submission-id'])
@@ -206,14 +366,19 @@ class JudgeHandler(ZlibPacketHandler):
 
     def on_batch_begin(self, packet):
         logger.info('%s: Batch began on: %s', self.name, packet['submission-id'])
-        self.in_batch = True
-        if self.batch_id is None:
-            self.batch_id = 0
-            self._submission_is_batch(packet['submission-id'])
-        self.batch_id += 1
+        submission = self.in_flight(packet)
+        if submission is None:
+            return
+        submission.in_batch = True
+        if submission.batch_id is None:
+            submission.batch_id = 0
+            self._submission_is_batch(submission.id)
+        submission.batch_id += 1
 
     def on_batch_end(self, packet):
-        self.in_batch = False
+        submission = self.in_flight(packet)
+        if submission is not None:
+            submission.in_batch = False
         logger.info('%s: Batch ended on: %s', self.name, packet['submission-id'])
 
     def on_test_case(self, packet):
@@ -232,5 +397,10 @@ class JudgeHandler(ZlibPacketHandler):
         self._update_ping()
 
     def _free_self(self, packet):
-        self._working = False
-        self.server.judges.on_judge_free(self, packet['submission-id'])
+        submission = self._working.pop(packet['submission-id'], None)
+        if submission is None:
+            logger.warning('%s: Finished a submission it was not grading: %s', self.name, packet['submission-id'])
+            return
+        if submission.no_response_job:
+            self.server.unschedule(submission.no_response_job)
+        self.server.judges.on_judge_free(self, submission.id)
@@ -1,84 +1,376 @@
 import logging
-from operator import attrgetter
+import time
+from heapq import heappop, heappush
+from itertools import count
 from threading import RLock
 
+from .dispatch import AffinityScorer, DispatchStats, JudgeRecord
+from .timings import SubmissionTimings
+
 logger = logging.getLogger('judge.bridge')
 
 
 class JudgeList(object):
-    def __init__(self):
-        self.queue = []
+    # Priority classes, most urgent first: live contest submissions, everything else, and rejudges. A submission
+    # is queued as if it arrived its class's delay later, so a long wait ages it past newer, more urgent ones.
+    priority_names = ('contest', 'default', 'rejudge')
+    priority_delays = (0, 60, 600)
+    default_priority = 1
+    # Each further submission a user has waiting in a class is queued at least this much after their last, so
+    # users take turns instead of one user's burst holding up everyone who submits after it.
+    user_spacing = 5
+    # Problems remembered per judge for affinity, and the weight of each grading in its average grading time.
+    recent_problems = 8
+    grading_smoothing = 0.2
+    # Times a submission goes back in the queue because its judge went away before it is given up on.
+    max_retries = 3
+
+    def __init__(self, scorer=None):
+        # Queued submissions by the (problem, language) they need, as heaps, and by id. Entries are
+        # (deadline, sequence, id, problem, language, source, priority, user), ordered by when they are due.
+        # Aborted entries are left in the heaps and dropped when they come up, but never sit at the top of one.
+        self.queues = {}
+        self.queued = {}
+        self._sequence = count()
+        # For each language, (deadline, sequence, problem) of the first entry of each of its queues, so a free
+        # judge looks at the queues for its languages in order. Entries left behind when the first entry of a
+        # queue changes are dropped as they come up.
+        self._heads = {}
+        # [deadline of the last submission, submissions queued] for each priority class and user.
+        self._users = {}
+        # Submissions queued for each language.
+        self._languages = {}
         self.judges = set()
+        # Judges with nothing to do, for new submissions to go straight to.
+        self.free = set()
         self.submission_map = {}
+        # (problem, language, source, priority, user) of each submission sent to a judge, to queue it again if
+        # the judge goes away, and how many times each has been queued again so far.
+        self.dispatched = {}
+        self.retries = {}
+        self.requeued = {}
+        self.abandoned = 0
+        self.scorer = scorer or AffinityScorer()
+        self.records = {}
+        self.dispatch_stats = DispatchStats()
+        self.timings = SubmissionTimings()
+        # A QueueJournal to record the queue in, if the server keeps one.
+        self.journal = None
+        # Cleared while the server hands its judges off, so the queue it sent stays as it was.
+        self.dispatching = True
         self.lock = RLock()
 
+    @property
+    def queue(self):
+        # (id, problem, language, source, priority, user, deadline) in order, as restore_queue takes them.
+        with self.lock:
+            return [entry[2:] + entry[:1] for entry in sorted(self.queued.itervalues())]
+
+    def composition(self):
+        with self.lock:
+            classes = [{'priority': name, 'submissions': 0, 'users': 0} for name in self.priority_names]
+            for (priority, user), (deadline, queued) in self._users.iteritems():
+                classes[priority]['submissions'] += queued
+                if user is not None:
+                    classes[priority]['users'] += 1
+            return classes
+
+    def capacity(self):
+        # For each language: submissions queued, judges that have it and their free slots.
+        with self.lock:
+            languages = {}
+            for judge in self.judges:
+                for language in judge.executors:
+                    stats = languages.setdefault(language, {'queued': 0, 'judges': 0, 'free-slots': 0})
+                    stats['judges'] += 1
+                    stats['free-slots'] += judge.free_slots
+            for language, queued in self._languages.iteritems():
+                languages.setdefault(language, {'queued': 0, 'judges': 0, 'free-slots': 0})['queued'] = queued
+            return languages
+
+    def timings_snapshot(self):
+        with self.lock:
+            return self.timings.snapshot()
+
+    def dispatch_snapshot(self):
+        with self.lock:
+            return self.dispatch_stats.snapshot()
+
+    def _enqueue(self, id, problem, language, source, priority=None, user=None, deadline=None):
+        if priority not in xrange(len(self.priority_names)):
+            priority = self.default_priority
+        clock = self._users.get((priority, user))
+        if deadline is None:
+            deadline = time.time() + self.priority_delays[priority]
+            if clock is not None and user is not None:
+                deadline = max(deadline, clock[0] + self.user_spacing)
+        if clock is None:
+            clock = self._users[priority, user] = [deadline, 0]
+        clock[0] = max(clock[0], deadline)
+        clock[1] += 1
+
+        key = problem, language
+        entry = (deadline, next(self._sequence), id, problem, language, source, priority, user)
+        queue = self.queues.setdefault(key, [])
+        if not queue or entry < queue[0]:
+            heappush(self._heads.setdefault(language, []), (deadline, entry[1], problem))
+        heappush(queue, entry)
+        self.queued[id] = entry
+        self._languages[language] = self._languages.get(language, 0) + 1
+        self.timings.queued(id, problem, language)
+        if self.journal is not None:
+            self.journal.queued(id, problem, language, priority, user, deadline)
+
+    def _dequeue(self, id):
+        entry = self.queued.pop(id)
+        clock = self._users[entry[6], entry[7]]
+        clock[1] -= 1
+        if not clock[1]:
+            del self._users[entry[6], entry[7]]
+
+        key = entry[3], entry[4]
+        self._languages[key[1]] -= 1
+        if not self._languages[key[1]]:
+            del self._languages[key[1]]
+        queue = self.queues[key]
+        if queue[0] is entry:
+            heappop(queue)
+            while queue and self.queued.get(queue[0][2]) is not queue[0]:
+                heappop(queue)
+            if queue:
+                heappush(self._heads[key[1]], (queue[0][0], queue[0][1], key[0]))
+            else:
+                del self.queues[key]
+        return entry
+
+    def _first(self, judge, language):
+        heads = self._heads[language]
+        skipped = []
+        found = None
+        while heads:
+            deadline, sequence, problem = heads[0]
+            queue = self.queues.get((problem, language))
+            entry = queue[0] if queue else None
+            if entry is None or entry[1] != sequence:
+                heappop(heads)
+            elif judge.can_judge(problem, language):
+                found = entry
+                break
+            else:
+                # Judges mostly share their problems, so there are few of these.
+                skipped.append(heappop(heads))
+        for head in skipped:
+            heappush(heads, head)
+        if not heads:
+            del self._heads[language]
+        return found
+
+    def _next_for(self, judge):
+        # The first submission due that the judge can take, looking only at the first queue for each of its
+        # languages that it has the problem for.
+        best = None
+        for language in [language for language in self._heads if language in judge.executors]:
+            entry = self._first(judge, language)
+            if entry is not None and (best is None or entry < best):
+                best = entry
+        return best
+
     def _handle_free_judge(self, judge):
+        # Fills the judge's free slots from the queue, leaving it in free if some are left over.
         with self.lock:
-            for i, elem in enumerate(self.queue):
-                id, problem, language, source = elem
-                if judge.can_judge(problem, language):
-                    self.submission_map[id] = judge
-                    logger.info('Dispatched queued submission %d: %s', id, judge.name)
-                    try:
-                        judge.submit(id, problem, language, source)
-                    except Exception:
-                        logger.exception('Failed to dispatch %d (%s, %s) to %s', id, problem, language, judge.name)
-                        self.judges.remove(judge)
-                        return
-                    del self.queue[i]
+            if not self.dispatching:
+                return
+            while judge in self.judges and judge.free_slots > 0:
+                entry = self._next_for(judge)
+                if entry is None:
+                    self.free.add(judge)
+                    return
+                id, problem, language, source, priority, user = entry[2:8]
+                self._begin(judge, id, problem)
+                self.submission_map[id] = judge
+                logger.info('Dispatched queued submission %d: %s', id, judge.name)
+                try:
+                    judge.submit(id, problem, language, source)
+                except Exception:
+                    logger.exception('Failed to dispatch %d (%s, %s) to %s', id, problem, language, judge.name)
+                    del self.submission_map[id]
+                    self.judges.discard(judge)
+                    self.records.pop(judge, None)
                     break
+                self._dequeue(id)
+                self.dispatched[id] = problem, language, source, priority, user
+                self.timings.dispatched(id, judge.name)
+                if self.journal is not None:
+                    self.journal.dispatched(id, judge.name)
+            self.free.discard(judge)
+
+    def _record(self, judge):
+        record = self.records.get(judge)
+        if record is None:
+            record = self.records[judge] = JudgeRecord(self.recent_problems)
+        return record
+
+    def _begin(self, judge, id, problem):
+        record = self._record(judge)
+        record.begin(id, problem, problem in record.problems)
 
     def register(self, judge):
         with self.lock:
             self.judges.add(judge)
             self._handle_free_judge(judge)
 
+    def restore(self, judge):
+        # A judge taken over from another bridge process, which may be in the middle of submissions.
+        with self.lock:
+            self.judges.add(judge)
+            for id in judge.get_current_submissions():
+                self.submission_map[id] = judge
+            self._handle_free_judge(judge)
+
+    def restore_queue(self, queue):
+        with self.lock:
+            for item in queue:
+                self._enqueue(*item)
+
     def update_problems(self, judge):
         with self.lock:
             self._handle_free_judge(judge)
 
+    def restore_dispatched(self, dispatched):
+        with self.lock:
+            for id, problem, language, priority, user, retries in dispatched:
+                self.dispatched[id] = problem, language, None, priority, user
+                if retries:
+                    self.retries[id] = retries
+
     def remove(self, judge):
+        """Takes a judge that went away off the list. Its submissions go back to the front of the queue, unless
+        they have been there max_retries times already. Returns the ids of those requeued and those given up.
+
+        Requeued submissions are not sent anywhere until dispatch_queued is called, so the caller can mark them
+        as queued first."""
+        requeued, abandoned = [], []
         with self.lock:
-            sub = judge.get_current_submission()
-            if sub is not None:
-                try:
-                    del self.submission_map[sub]
-                except KeyError:
-                    pass
             self.judges.discard(judge)
+            self.free.discard(judge)
+            self.records.pop(judge, None)
+            for sub in judge.get_current_submissions():
+                if self.submission_map.get(sub) is not judge:
+                    continue
+                del self.submission_map[sub]
+                retries = self.retries[sub] = self.retries.get(sub, 0) + 1
+                if sub not in self.dispatched or retries > self.max_retries:
+                    self.dispatched.pop(sub, None)
+                    del self.retries[sub]
+                    self.abandoned += 1
+                    abandoned.append(sub)
+                    self.timings.forget(sub)
+                    if self.journal is not None:
+                        self.journal.finished(sub)
+                    continue
+                problem, language, source, priority, user = self.dispatched.pop(sub)
+                logger.warning('Requeued %d (%s, %s) from %s, retry %d', sub, problem, language, judge.name, retries)
+                self.requeued[problem] = self.requeued.get(problem, 0) + 1
+                self._enqueue(sub, problem, language, source, priority, user, 0)
+                requeued.append(sub)
+        return requeued, abandoned
+
+    def dispatch_queued(self):
+        """Hands queued submissions to any free judges that can take them."""
+        with self.lock:
+            for judge in list(self.free):
+                self._handle_free_judge(judge)
+
+    @property
+    def dispatched_state(self):
+        # (id, problem, language, priority, user, retries) of submissions being graded, as restore_dispatched
+        # takes them. Sources are left out, to be loaded again if they are requeued.
+        with self.lock:
+            return [(id, problem, language, priority, user, self.retries.get(id, 0))
+                    for id, (problem, language, source, priority, user) in self.dispatched.iteritems()]
+
+    def requeue_stats(self):
+        with self.lock:
+            return {
+                'requeued': sum(self.requeued.itervalues()),
+                'abandoned': self.abandoned,
+                'retrying': len(self.retries),
+                'problems': dict(sorted(self.requeued.iteritems(), key=lambda item: -item[1])[:20]),
+            }
 
     def __iter__(self):
         return iter(self.judges)
 
     def on_judge_free(self, judge, submission):
         with self.lock:
+            if self.submission_map.get(submission) is not judge:
+                logger.warning('%s finished %d, which it is no longer grading', judge.name, submission)
+                return
             logger.info('Judge available after grading %d: %s', submission, judge.name)
             del self.submission_map[submission]
+            self.dispatched.pop(submission, None)
+            self.retries.pop(submission, None)
+            self.timings.finished(submission)
+            if self.journal is not None:
+                self.journal.finished(submission)
+            graded = self._record(judge).end(submission, self.grading_smoothing)
+            if graded is not None:
+                self.dispatch_stats.graded(*graded)
             self._handle_free_judge(judge)
 
+    def on_acknowledged(self, judge, submission):
+        with self.lock:
+            self.timings.acknowledged(submission)
+
     def abort(self, submission):
+        """Stops a submission. Returns True if it was still queued, and so will never reach a judge."""
         with self.lock:
             logger.info('Abort request: %d', submission)
-            self.submission_map[submission].abort()
+            if submission in self.queued:
+                self._dequeue(submission)
+                self.retries.pop(submission, None)
+                self.timings.forget(submission)
+                if self.journal is not None:
+                    self.journal.finished(submission)
+                return True
+            self.submission_map[submission].abort(submission)
+            return False
 
-    def judge(self, id, problem, language, source):
+    def judge(self, id, problem, language, source, priority=None, user=None):
+        """Sends a submission to a free judge, or queues it. Returns False if it was already queued or being
+        graded, and so was left alone."""
         with self.lock:
-            if id in self.submission_map:
+            if id in self.submission_map or id in self.queued:
                 logger.warning('Already judging? %d', id)
-                return
+                return False
 
-            candidates = [judge for judge in self.judges if not judge.working and judge.can_judge(problem, language)]
+            candidates = [judge for judge in self.free if self.dispatching and judge.can_judge(problem, language)]
             logger.info('Free judges: %d', len(candidates))
             if candidates:
-                judge = min(candidates, key=attrgetter('load'))
+                judge = min(candidates, key=lambda judge: self.scorer.score(judge, self._record(judge),
+                                                                             problem, language))
+                self.dispatch_stats.decided(len(candidates))
                 logger.info('Dispatched submission %d to: %s', id, judge.name)
+                self.free.discard(judge)
+                self._begin(judge, id, problem)
                 self.submission_map[id] = judge
                 try:
                     judge.submit(id, problem, language, source)
                 except Exception:
                     logger.exception('Failed to dispatch %d (%s, %s) to %s', id, problem, language, judge.name)
+                    del self.submission_map[id]
                     self.judges.discard(judge)
-                    return self.judge(id, problem, language, source)
+                    self.records.pop(judge, None)
+                    return self.judge(id, problem, language, source, priority, user)
+                self.dispatched[id] = problem, language, source, priority, user
+                self.timings.queued(id, problem, language)
+                self.timings.dispatched(id, judge.name)
+                if self.journal is not None:
+                    self.journal.queued(id, problem, language, priority, user, None)
+                    self.journal.dispatched(id, judge.name)
+                if judge.free_slots > 0:
+                    self.free.add(judge)
             else:
-                self.queue.append((id, problem, language, source))
+                self._enqueue(id, problem, language, source, priority, user)
                 logger.info('Queued submission: %d', id)
+            return True
@@ -1,10 +1,10 @@
 import logging
-import threading
-import time
 import os
 from event_socket_server import get_preferred_engine
 
-from judge.models import Judge
+from judge.models import Judge, Submission
+from .admission import AdmissionController
+from .journal import QueueJournal, replay
 from .judgelist import JudgeList
 
 logger = logging.getLogger('judge.bridge')
@@ -15,27 +15,102 @@ def reset_judges():
 
 
 class JudgeServer(get_preferred_engine()):
+    # Judges whose handshakes are processed at once. When the bridge restarts every judge reconnects together,
+    # and each handshake rewrites the judge's problems and runtimes; the rest wait their turn.
+    handshake_limit = 2
+
     def __init__(self, *args, **kwargs):
+        handshake_limit = kwargs.pop('handshake_limit', None)
         super(JudgeServer, self).__init__(*args, **kwargs)
         reset_judges()
         self.judges = JudgeList()
-        self.ping_judge_thread = threading.Thread(target=self.ping_judge, args=())
-        self.ping_judge_thread.daemon = True
-        self.ping_judge_thread.start()
+        self.journal_path = None
+        self.handshakes = AdmissionController(self, handshake_limit or self.handshake_limit)
+        self.schedule(10, self.ping_judge)
 
     def on_shutdown(self):
         super(JudgeServer, self).on_shutdown()
         reset_judges()
 
+    def open_journal(self, path):
+        """Picks up the queue journal at path and records to it from now on. Only one process may have the
+        journal open, so this is done after taking over from the old bridge, or on a cold start."""
+        self.journal_path = path
+        self.judges.journal = QueueJournal(path, replay(path))
+
+    def close_journal(self):
+        if self.judges.journal is not None:
+            self.judges.journal.close()
+            self.judges.journal = None
+
+    def handoff_state(self):
+        # The new process opens the journal once it has this state, so it must be closed here first.
+        self.close_journal()
+        with self.judges.lock:
+            # Anything sent to a judge from here on would go to a connection that is no longer this process's.
+            self.judges.dispatching = False
+            return {'queue': self.judges.queue, 'dispatched': self.judges.dispatched_state}
+
+    def handoff_failed(self):
+        super(JudgeServer, self).handoff_failed()
+        if self.journal_path is not None:
+            self.open_journal(self.journal_path)
+        self.judges.dispatching = True
+        self.judges.dispatch_queued()
+
+    def restore_state(self, state):
+        self.judges.restore_queue(state['queue'])
+        self.judges.restore_dispatched(state.get('dispatched', []))
+
+    def restore(self, state, fds, handlers):
+        super(JudgeServer, self).restore(state, fds, handlers)
+        # Marked offline when this server started.
+        Judge.objects.filter(name__in=[judge.name for judge in self.judges]).update(online=True)
+
+    def recover(self):
+        """Queues again every submission the site still has as queued or being graded, as after the bridge dies.
+        The journal, if any, keeps their priorities and places in the queue."""
+        journal = self.judges.journal
+        live = journal.live if journal is not None else {}
+        rejudge = self.judges.priority_names.index('rejudge')
+        queue = []
+        for id, problem, language, user, rejudged in Submission.objects.filter(status__in=('QU', 'P', 'G')) \
+                .values_list('id', 'problem__code', 'language__key', 'user_id', 'is_being_rejudged'):
+            if id in live:
+                priority, deadline = live[id][2], live[id][4]
+            else:
+                priority, deadline = rejudge if rejudged else None, None
+            queue.append((id, problem, language, None, priority, user, deadline))
+        ids = set(item[0] for item in queue)
+        if journal is not None:
+            for id in set(live).difference(ids):
+                journal.finished(id)
+        Submission.objects.filter(id__in=ids, status__in=('P', 'G')).update(status='QU')
+        self.judges.restore_queue(queue)
+        logger.info('Requeued %d pending submissions', len(queue))
+
+    def stats(self):
+        stats = super(JudgeServer, self).stats()
+        stats['handshakes'] = self.handshakes.stats()
+        stats['queue'] = self.judges.composition()
+        stats['dispatch'] = self.judges.dispatch_snapshot()
+        stats['requeues'] = self.judges.requeue_stats()
+        stats['languages'] = self.judges.capacity()
+        stats['timings'] = self.judges.timings_snapshot()
+        if self.judges.journal is not None:
+            stats['journal'] = self.judges.journal.stats()
+        return stats
+
     def ping_judge(self):
+        # Runs on the event loop, so the pings go straight out instead of being handed over by another thread.
         try:
-            while True:
-                for judge in self.judges:
-                    judge.ping()
-                time.sleep(10)
-        except:
+            with self.judges.lock:
+                judges = list(self.judges)
+            for judge in judges:
+                judge.ping()
+        except Exception:
             logger.exception('Ping error')
-            raise
+        self.schedule(10, self.ping_judge)
 
 
 def main():
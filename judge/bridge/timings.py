@@ -0,0 +1,93 @@
+import time
+from collections import deque
+
+from event_socket_server.metrics import Histogram
+
+
+class RollingHistogram(object):
+    """A Histogram of the samples added in about the last window seconds, kept in parts so old ones can be
+    dropped a part at a time."""
+
+    def __init__(self, window, parts=6, unit=1e-3):
+        self.part_length = window / float(parts)
+        self.parts = deque(maxlen=parts)
+        self.unit = unit
+
+    def add(self, value, now):
+        start = now - now % self.part_length
+        if not self.parts or self.parts[-1][0] != start:
+            self.parts.append((start, Histogram(self.unit)))
+        self.parts[-1][1].add(value)
+
+    def snapshot(self, now):
+        oldest = now - self.part_length * self.parts.maxlen
+        return Histogram.combine([histogram for start, histogram in self.parts if start > oldest],
+                                 self.unit).snapshot()
+
+
+class SubmissionTimings(object):
+    """When each submission was queued, sent to a judge, acknowledged by it and finished, and how long
+    submissions have recently waited in the queue and taken to grade, by language, problem and judge.
+
+    Grading time runs from the judge acknowledging a submission, or from sending it if the judge never did.
+    """
+    window = 3600
+
+    def __init__(self):
+        # id: [problem, language, queued, dispatched, judge, acknowledged]
+        self.submissions = {}
+        self.queue_wait = {'language': {}, 'problem': {}, 'judge': {}}
+        self.grading_time = {'language': {}, 'problem': {}, 'judge': {}}
+
+    def _add(self, histograms, value, now, **keys):
+        for kind, key in keys.iteritems():
+            histogram = histograms[kind].get(key)
+            if histogram is None:
+                histogram = histograms[kind][key] = RollingHistogram(self.window)
+            histogram.add(value, now)
+
+    def queued(self, id, problem, language):
+        self.submissions[id] = [problem, language, time.time(), None, None, None]
+
+    def dispatched(self, id, judge):
+        submission = self.submissions.get(id)
+        if submission is None:
+            return
+        now = submission[3] = time.time()
+        submission[4] = judge
+        self._add(self.queue_wait, now - submission[2], now,
+                  language=submission[1], problem=submission[0], judge=judge)
+
+    def acknowledged(self, id):
+        submission = self.submissions.get(id)
+        if submission is not None and submission[5] is None:
+            submission[5] = time.time()
+
+    def finished(self, id):
+        submission = self.submissions.pop(id, None)
+        if submission is None or submission[3] is None:
+            return
+        now = time.time()
+        self._add(self.grading_time, now - (submission[5] or submission[3]), now,
+                  language=submission[1], problem=submission[0], judge=submission[4])
+
+    def forget(self, id):
+        self.submissions.pop(id, None)
+
+    def _snapshot(self, histograms, now, limit):
+        snapshot = {}
+        for kind, by_key in histograms.iteritems():
+            stats = [(key, histogram.snapshot(now)) for key, histogram in by_key.iteritems()]
+            if kind == 'problem':
+                # Only the busiest problems; there can be thousands.
+                stats = sorted(stats, key=lambda item: -item[1]['count'])[:limit]
+            snapshot[kind] = dict((key, stats) for key, stats in stats if stats['count'])
+        return snapshot
+
+    def snapshot(self, limit=20):
+        now = time.time()
+        return {
+            'window': self.window,
+            'queue-wait': self._snapshot(self.queue_wait, now, limit),
+            'grading-time': self._snapshot(self.grading_time, now, limit),
+        }
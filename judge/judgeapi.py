@@ -10,10 +10,26 @@ from judge import event_poster as event
 logger = logging.getLogger('judge.judgeapi')
 size_pack = struct.Struct('!I')
 
+# Priority classes for the bridge's queue, most urgent first.
+CONTEST_PRIORITY = 0
+DEFAULT_PRIORITY = 1
+REJUDGE_PRIORITY = 2
 
-def judge_request(packet, reply=True):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((settings.BRIDGED_DJANGO_HOST, settings.BRIDGED_DJANGO_PORT))
+
+def bridge_connection(timeout=None):
+    if settings.BRIDGED_DJANGO_UNIX_SOCKET:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(settings.BRIDGED_DJANGO_UNIX_SOCKET)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect((settings.BRIDGED_DJANGO_HOST, settings.BRIDGED_DJANGO_PORT))
+    return sock
+
+
+def judge_request(packet, reply=True, timeout=None):
+    sock = bridge_connection(timeout)
 
     output = json.dumps(packet, separators=(',', ':'))
     output = output.encode('zlib')
@@ -39,6 +55,14 @@ def judge_request(packet, reply=True):
         return result
 
 
+def submission_priority(submission):
+    if submission.is_being_rejudged:
+        return REJUDGE_PRIORITY
+    if hasattr(submission, 'contest') and not submission.contest.participation.ended:
+        return CONTEST_PRIORITY
+    return DEFAULT_PRIORITY
+
+
 def judge_submission(submission):
     from .models import SubmissionTestCase
     submission.time = None
@@ -55,6 +79,8 @@ def judge_submission(submission):
             'problem-id': submission.problem.code,
             'language': submission.language.key,
             'source': submission.source,
+            'priority': submission_priority(submission),
+            'user-id': submission.user_id,
         })
     except BaseException:
         logger.exception('Failed to send request to judge')
@@ -72,5 +98,57 @@ def judge_submission(submission):
     return success
 
 
+def judge_submissions(queryset, batch_size=1000, progress=None):
+    """Rejudges every submission in queryset, batch_size at a time, at rejudge priority.
+
+    Each batch is reset with one UPDATE and one DELETE of its test cases, and sent to the bridge as ids only.
+    Submission lists are told of each one, as for a single rejudge. progress(done, total) is called after each
+    batch. Returns the number of submissions the bridge queued.
+    """
+    from .models import Submission, SubmissionTestCase
+    ids = list(queryset.order_by('id').values_list('id', flat=True).distinct())
+    queued = 0
+    for start in xrange(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        # Queued before the bridge has them, so a judge picking one up straight away isn't overwritten.
+        Submission.objects.filter(id__in=batch).update(time=None, memory=None, points=None, result=None,
+                                                        error=None, status='QU', is_being_rejudged=True)
+        SubmissionTestCase.objects.filter(submission_id__in=batch).delete()
+        try:
+            response = judge_request({
+                'name': 'submission-batch-request',
+                'submission-ids': batch,
+                'priority': REJUDGE_PRIORITY,
+            })
+        except BaseException:
+            logger.exception('Failed to send batch request to judge')
+            received, skipped = [], []
+        else:
+            if response['name'] == 'submission-batch-received':
+                # Skipped ones were already queued or being graded there, and are left to finish.
+                received, skipped = response.get('submission-ids', []), response.get('skipped-ids', [])
+            else:
+                received, skipped = [], []
+        missing = set(batch).difference(received, skipped)
+        if missing:
+            Submission.objects.filter(id__in=missing).update(status='IE')
+        queued += len(received)
+        for id, contest, user, problem in Submission.objects.filter(id__in=batch, problem__is_public=True) \
+                .values_list('id', 'contest__participation__contest__key', 'user_id', 'problem_id'):
+            event.post('submissions', {'type': 'update-submission', 'id': id, 'contest': contest,
+                                       'user': user, 'problem': problem})
+        if progress is not None:
+            progress(start + len(batch), len(ids))
+    return queued
+
+
 def abort_submission(submission):
     judge_request({'name': 'terminate-submission', 'submission-id': submission.id}, reply=False)
+
+
+def bridge_stats():
+    return judge_request({'name': 'stats'})['server']
+
+
+def bridge_queue_stats(timeout=None):
+    return judge_request({'name': 'queue-stats'}, timeout=timeout)['stats']
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from judge.judgeapi import judge_submissions
+from judge.models import Submission
+
+
+class Command(BaseCommand):
+    help = 'rejudges submissions in batches, by id or by problem, user, language and result'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='ids of submissions to rejudge')
+        parser.add_argument('-p', '--problem', action='append', default=[], help='code of a problem to rejudge')
+        parser.add_argument('-u', '--user', action='append', default=[], help='username whose submissions to rejudge')
+        parser.add_argument('-l', '--language', action='append', default=[], help='key of a language to rejudge')
+        parser.add_argument('-r', '--result', action='append', default=[], help='result to rejudge, e.g. AC or IE')
+        parser.add_argument('-b', '--batch-size', type=int, default=1000, help='submissions sent to the bridge at once')
+
+    def handle(self, *args, **options):
+        if not any(options[key] for key in ('ids', 'problem', 'user', 'language', 'result')):
+            raise CommandError('Refusing to rejudge every submission: give ids or a filter')
+        if options['batch_size'] < 1:
+            raise CommandError('Invalid batch size: %d' % options['batch_size'])
+
+        queryset = Submission.objects.all()
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+        if options['problem']:
+            queryset = queryset.filter(problem__code__in=options['problem'])
+        if options['user']:
+            queryset = queryset.filter(user__user__username__in=options['user'])
+        if options['language']:
+            queryset = queryset.filter(language__key__in=options['language'])
+        if options['result']:
+            queryset = queryset.filter(result__in=options['result'])
+
+        def progress(done, total):
+            self.stdout.write('%d/%d submissions sent' % (done, total))
+
+        queued = judge_submissions(queryset, options['batch_size'], progress)
+        self.stdout.write('%d submissions queued for rejudging' % queued)
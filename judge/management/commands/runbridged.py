@@ -1,23 +1,49 @@
-import threading
-
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from judge.bridge import DjangoHandler, DjangoServer
-from judge.bridge import DjangoJudgeHandler, JudgeServer
+from event_socket_server import PacketExecutor
+from event_socket_server.handoff import HandoffHandler, take_over
+from judge.bridge import DjangoHandler, DjangoJudgeHandler, JudgeServer
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--take-over', action='store_true',
+                            help='take over the connections of the bridge running now instead of starting afresh')
+
     def handle(self, *args, **options):
-        judge_server = JudgeServer(settings.BRIDGED_JUDGE_HOST, settings.BRIDGED_JUDGE_PORT, DjangoJudgeHandler)
-        django_server = DjangoServer(judge_server.judges, settings.BRIDGED_DJANGO_HOST, settings.BRIDGED_DJANGO_PORT,
-                                     DjangoHandler)
+        if options['take_over'] and not settings.BRIDGED_HANDOFF_SOCKET:
+            raise CommandError('Taking over needs BRIDGED_HANDOFF_SOCKET')
+        if options['take_over'] and not JudgeServer.supports_handoff:
+            raise CommandError('Taking over is not supported by the bridge event loop engine')
 
-        # TODO: Merge the two servers
-        threading.Thread(target=django_server.serve_forever).start()
+        workers = settings.BRIDGED_JUDGE_WORKERS
+        server = JudgeServer(None, None, DjangoJudgeHandler,
+                             executor=PacketExecutor(workers) if workers else None,
+                             stats_interval=settings.BRIDGED_STATS_INTERVAL,
+                             listen_backlog=settings.BRIDGED_LISTEN_BACKLOG,
+                             handshake_limit=settings.BRIDGED_JUDGE_HANDSHAKES)
+        handlers = [DjangoJudgeHandler, DjangoHandler, HandoffHandler]
+        if options['take_over'] and take_over(server, settings.BRIDGED_HANDOFF_SOCKET, handlers):
+            # The old bridge closed the journal before handing off.
+            if settings.BRIDGED_QUEUE_JOURNAL:
+                server.open_journal(settings.BRIDGED_QUEUE_JOURNAL)
+        else:
+            server.add_listener(settings.BRIDGED_JUDGE_HOST, settings.BRIDGED_JUDGE_PORT, DjangoJudgeHandler)
+            # The site talks to the same event loop, so its requests reach the judges without crossing threads.
+            if settings.BRIDGED_DJANGO_UNIX_SOCKET:
+                server.add_listener(settings.BRIDGED_DJANGO_UNIX_SOCKET, None, DjangoHandler)
+            else:
+                server.add_listener(settings.BRIDGED_DJANGO_HOST, settings.BRIDGED_DJANGO_PORT, DjangoHandler)
+            if settings.BRIDGED_HANDOFF_SOCKET:
+                server.add_listener(settings.BRIDGED_HANDOFF_SOCKET, None, HandoffHandler)
+            # Only once the listeners are bound, so a bridge still running keeps the journal to itself.
+            if settings.BRIDGED_QUEUE_JOURNAL:
+                server.open_journal(settings.BRIDGED_QUEUE_JOURNAL)
+            server.recover()
         try:
-            judge_server.serve_forever()
+            server.serve_forever()
         except KeyboardInterrupt:
             pass
         finally:
-            django_server.stop()
+            server.close_journal()
@@ -1,15 +1,29 @@
+import logging
 from itertools import chain
 
+from django.core.cache import cache
 from django.http import Http404
 from django.shortcuts import render
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 from django.views.generic import DetailView
 
-from judge.models import Judge
+from judge.judgeapi import bridge_queue_stats
+from judge.models import Judge, Language
 from judge.utils.views import TitleMixin, generic_message
 
 
 __all__ = ['status_all', 'status_table', 'JudgeDetail']
+logger = logging.getLogger('judge.views.status')
+
+PRIORITY_NAMES = {
+    'contest': ugettext_lazy('Live contest'),
+    'default': ugettext_lazy('Normal'),
+    'rejudge': ugettext_lazy('Rejudge'),
+}
+
+# Seconds to wait for the bridge, and to keep what it said, so the page never hangs on it or asks it every view.
+QUEUE_STATS_TIMEOUT = 2
+QUEUE_STATS_CACHE_TIME = 5
 
 
 def get_judges(request):
@@ -19,13 +33,48 @@ def get_judges(request):
         return False, Judge.objects.filter(online=True)
 
 
+def get_queue_stats():
+    # An empty dict when the bridge could not be reached, cached as well so a dead bridge isn't waited on each time.
+    stats = cache.get('bridge_queue_stats')
+    if stats is None:
+        try:
+            stats = bridge_queue_stats(timeout=QUEUE_STATS_TIMEOUT)
+        except Exception:
+            logger.exception('Failed to get the queue from the bridge')
+            stats = {}
+        cache.set('bridge_queue_stats', stats, QUEUE_STATS_CACHE_TIME)
+    return stats
+
+
+def get_queue():
+    stats = get_queue_stats()
+    if not stats:
+        return None, None
+    priorities = stats['priorities']
+    for priority in priorities:
+        priority['name'] = PRIORITY_NAMES.get(priority['priority'], priority['priority'])
+
+    # What each runtime has queued and free, and how long its submissions have waited and taken lately.
+    waits = stats['timings']['queue-wait']['language']
+    grading = stats['timings']['grading-time']['language']
+    names = dict(Language.objects.filter(key__in=stats['languages']).values_list('key', 'name'))
+    languages = []
+    for key, capacity in sorted(stats['languages'].iteritems()):
+        capacity.update(key=key, name=names.get(key, key), free_slots=capacity.pop('free-slots'),
+                        wait=waits.get(key), grading=grading.get(key))
+        languages.append(capacity)
+    return priorities, languages
+
+
 def status_all(request):
     see_all, judges = get_judges(request)
-    return render(request, 'judge_status.jade', {
+    context = {
         'title': _('Status'),
         'judges': judges,
         'see_all_judges': see_all,
-    })
+    }
+    context['queue'], context['queue_languages'] = get_queue()
+    return render(request, 'judge_status.jade', context)
 
 
 def status_table(request):